@@ -29,7 +29,12 @@
 
 import sys
 import os
-import re
+import json
+import time
+from collections import Counter
+from subprocess import Popen, PIPE
+
+from osqutil.utilities import SSH_MUX_OPTS
 
 """Check the status of LSF cluster and number of pending and running jobs for a particular user. Besides returning general cluster and user level statistics, returns user status in cluster, either \'BUSY\' or \'OK\' depending if suggested maximum number of running and pending jobs has been exceeded. The script assumes password free ssh to the LSF cluster headnode."""
 
@@ -38,41 +43,148 @@ __date__ = "28 Dec 2012"
 __version__ = "0.1"
 __credits__ = "Margus Lukk"
 
-def get_lsfhosts(server):
-    hosts=0
-    runjobs=0
+# Marker line used to separate the bhosts and bjobs output when both
+# commands are run within a single ssh session.
+OUTPUT_SEP = '__SEP__'
+
+# LSF can emit structured JSON output (LSF 10.1 and later), which saves
+# us scraping the whitespace-padded columnar output.
+BHOSTS_CMD = 'bhosts -o "host_name status max run" -json'
+BJOBS_CMD  = 'bjobs -u %s -o "stat" -json'
+
+# Plain columnar output, used where the JSON commands are unsupported.
+# bjobs reports "No unfinished job found" on stderr.
+BHOSTS_TEXT_CMD = 'bhosts'
+BJOBS_TEXT_CMD  = 'bjobs -u %s 2>&1'
+
+# Cached results, so that a caller polling in a tight loop does not
+# hit the headnode on every call. bhosts output changes slowly; user
+# job counts gate job submission and so are refreshed more often.
+HOSTS_TTL = 20 # seconds
+JOBS_TTL  = 5  # seconds
+_CACHE = {}
+
+def _cache_get(key, ttl):
+    entry = _CACHE.get(key)
+    if entry is not None and time.time() - entry[0] < ttl:
+        return entry[1]
+    return None
+
+def _cache_set(key, value):
+    _CACHE[key] = (time.time(), value)
+
+def _as_int(value):
+    # LSF reports unset numeric fields as '-'.
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+def _load_records(text):
+    # Returns None where the output is not LSF JSON (empty output from
+    # a failed command, an error message, or LSF before 10.1), leaving
+    # the caller to rerun the plain command instead.
+    try:
+        output = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(output, dict):
+        return None
+    return output.get('RECORDS', [])
+
+def parse_lsfhosts(text):
     # find number of active hosts and jobs running in cluster
-    cmd ='ssh %s bhosts' % server
-    pOut = os.popen(cmd,'r',1)
-    for line in pOut:
-        line = re.sub('\s+',' ',line)
-        ## print "Line: \"%s\"" %line
-        cols = line.split(' ')
-        if cols[1] == "ok":
-            hosts = hosts + int(cols[3])
-            runjobs = runjobs + int(cols[5])
-    pOut.close()
+    records = _load_records(text)
+    if records is None:
+        return None
+    okhosts = [ rec for rec in records if rec.get('STATUS') == 'ok' ]
+    hosts   = sum(_as_int(rec.get('MAX')) for rec in okhosts)
+    runjobs = sum(_as_int(rec.get('RUN')) for rec in okhosts)
+    return hosts,runjobs
+
+def parse_lsfuser_jobs(text):
+    # Count job states in a single pass over the bjobs output.
+    records = _load_records(text)
+    if records is None:
+        return None
+    states = Counter(rec.get('STAT') for rec in records)
+    return states['PEND'],states['RUN']
+
+def parse_lsfhosts_text(text):
+    # Plain bhosts columns: HOST_NAME STATUS JL/U MAX NJOBS RUN ...
+    lines = text.splitlines()
+    if not lines or not lines[0].startswith('HOST_NAME'):
+        raise StandardError("Unexpected bhosts output: %r" % text[:200])
+    rows    = [ line.split() for line in lines[1:] ]
+    okhosts = [ cols for cols in rows if len(cols) > 5 and cols[1] == 'ok' ]
+    hosts   = sum(_as_int(cols[3]) for cols in okhosts)
+    runjobs = sum(_as_int(cols[5]) for cols in okhosts)
+    return hosts,runjobs
+
+def parse_lsfuser_jobs_text(text):
+    # Plain bjobs columns: JOBID USER STAT ...
+    if 'No unfinished job found' in text:
+        return 0,0
+    lines = text.splitlines()
+    if not lines or not lines[0].startswith('JOBID'):
+        raise StandardError("Unexpected bjobs output: %r" % text[:200])
+    states = Counter(cols[2] for cols in (line.split() for line in lines[1:])
+                     if len(cols) > 2)
+    return states['PEND'],states['RUN']
+
+def run_remote(server, remote_cmd):
+    '''Run a command on the server, returning its stdout as a string.'''
+    # SSH_MUX_OPTS has the first call open a master connection which
+    # later calls reuse, saving a full handshake per command.
+    cmd = ['ssh'] + SSH_MUX_OPTS.split() + [server, remote_cmd]
+    return Popen(cmd, stdout=PIPE).communicate()[0]
+
+def _fetch_lsfhosts_text(server):
+    return parse_lsfhosts_text(run_remote(server, BHOSTS_TEXT_CMD))
+
+def _fetch_lsfuser_jobs_text(server,user):
+    return parse_lsfuser_jobs_text(run_remote(server, BJOBS_TEXT_CMD % user))
+
+def get_lsfhosts(server):
+    cached = _cache_get(('hosts', server), HOSTS_TTL)
+    if cached is not None:
+        return cached
+    (hosts,runjobs) = (parse_lsfhosts(run_remote(server, BHOSTS_CMD))
+                       or _fetch_lsfhosts_text(server))
+    _cache_set(('hosts', server), (hosts,runjobs))
     return hosts,runjobs
 
 def get_lsfuser_jobs(server,user):
-    pendjobs = 0
-    runjobs = 0
-
-    cmd ='ssh %s bjobs -u %s 2>&1' % (server,user)
-    pOut = os.popen(cmd,'r',1)
-    for line in pOut:
-        line = re.sub('\s+',' ',line)
-        cols = line.split(' ')
-        if cols[2] == "PEND":
-            pendjobs = pendjobs + 1 
-        if cols[2] == "RUN":
-            runjobs = runjobs + 1
-    pOut.close()
+    cached = _cache_get(('jobs', server, user), JOBS_TTL)
+    if cached is not None:
+        return cached
+    (pendjobs,runjobs) = (parse_lsfuser_jobs(run_remote(server, BJOBS_CMD % user))
+                          or _fetch_lsfuser_jobs_text(server,user))
+    _cache_set(('jobs', server, user), (pendjobs,runjobs))
     return pendjobs,runjobs
-    
+
+def get_lsfhosts_and_user_jobs(server,user):
+    # Where the host summary is still fresh only bjobs needs rerunning.
+    hostinfo = _cache_get(('hosts', server), HOSTS_TTL)
+    if hostinfo is not None:
+        return hostinfo + get_lsfuser_jobs(server,user)
+
+    # Otherwise run bhosts and bjobs in one remote shell, saving an ssh
+    # handshake, and split the output locally.
+    remote_cmd = '%s; echo %s; %s' % (BHOSTS_CMD, OUTPUT_SEP, BJOBS_CMD % user)
+    stdout = run_remote(server, remote_cmd)
+    (hosttext, sep, jobtext) = stdout.partition(OUTPUT_SEP + '\n')
+    # Anything not returned as JSON is fetched again as plain text.
+    (hosts,runjobs) = (parse_lsfhosts(hosttext)
+                       or _fetch_lsfhosts_text(server))
+    (pendjobs,urunjobs) = (parse_lsfuser_jobs(jobtext)
+                           or _fetch_lsfuser_jobs_text(server,user))
+    _cache_set(('hosts', server), (hosts,runjobs))
+    _cache_set(('jobs', server, user), (pendjobs,urunjobs))
+    return (hosts,runjobs,pendjobs,urunjobs)
+
 def get_cluster_summary(server,user,maxrun,maxpend):
-    (hosts,runjobs) = get_lsfhosts(server)
-    (upendjobs,urunjobs) = get_lsfuser_jobs(server,user)        
+    (hosts,runjobs,upendjobs,urunjobs) = get_lsfhosts_and_user_jobs(server,user)
     status = "BUSY"
     if urunjobs < maxrun and upendjobs < maxpend:
         status = "OK"
@@ -108,7 +220,10 @@ if __name__ == '__main__':
     
     print "---------"
     print "User: %s" % ARGS.user
-    (hosts,runjobs,upendjobs,urunjobs,status) = get_cluster_summary(ARGS.server,ARGS.user,ARGS.maxjobs,ARGS.maxpendjobs)
+    try:
+        (hosts,runjobs,upendjobs,urunjobs,status) = get_cluster_summary(ARGS.server,ARGS.user,ARGS.maxjobs,ARGS.maxpendjobs)
+    except StandardError, err:
+        sys.exit("Unable to read cluster status: %s" % err)
     print "Available nodes: %s" % hosts
     print "Occupied nodes: %s" % runjobs
     print "%s pending: %s" % (ARGS.user,upendjobs)
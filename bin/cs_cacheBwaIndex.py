@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Make a node-local copy of a bwa genome index, for use by the bwa mem
+jobs run on that node. Each genome is cached in its own directory
+under a shared cache directory (typically under /dev/shm). Only the
+index files themselves are copied; copies are written under a
+temporary name and renamed into place, so that jobs already holding
+the old files open (or mmapped) are unaffected. Cached genomes which
+have not been used for a while are removed, and where there is not
+enough room for a copy the cache directory is populated with symlinks
+to the original files instead, so the index path stays usable.
+'''
+
+import os
+import sys
+import time
+import fcntl
+import shutil
+
+from osqutil.setup_logs import configure_logging
+from logging import INFO, WARNING
+LOGGER = configure_logging(level=INFO)
+
+# Marker file touched each time a cached genome is used.
+STAMP = '.used'
+
+# Fraction of the cache filesystem left free after copying an index.
+MIN_FREE_FRACTION = 0.1
+
+################################################################################
+
+def _is_current(src, dst):
+  '''
+  True if dst is a real (non-symlink) copy of src made after src was
+  last modified.
+  '''
+  if os.path.islink(dst) or not os.path.exists(dst):
+    return False
+  sstat = os.stat(src)
+  dstat = os.stat(dst)
+  return dstat.st_size == sstat.st_size and dstat.st_mtime >= sstat.st_mtime
+
+def _replace(dst, src, link=False):
+  '''
+  Put a copy of (or symlink to) src in place at dst via a temporary
+  name and rename.
+  '''
+  tmp = "%s.tmp%d" % (dst, os.getpid())
+  if link:
+    os.symlink(os.path.abspath(src), tmp)
+  else:
+    shutil.copy2(src, tmp)
+  os.rename(tmp, dst)
+
+def evict_stale(cacheroot, keep, max_age):
+  '''
+  Remove the cached genomes under cacheroot, other than keep, which
+  have not been used in the last max_age days. Directories without a
+  usage stamp were not created by this script, and are left alone.
+  '''
+  cutoff = time.time() - max_age * 86400
+  for name in os.listdir(cacheroot):
+    path = os.path.join(cacheroot, name)
+    if path == keep or not os.path.isdir(path):
+      continue
+    stamp = os.path.join(path, STAMP)
+    if os.path.exists(stamp) and os.path.getmtime(stamp) < cutoff:
+      LOGGER.info("Removing unused cached index %s", path)
+      shutil.rmtree(path, ignore_errors=True)
+
+def cache_index(genome, cachedir, extensions, max_age=7):
+  '''
+  Cache the index files (genome + each of extensions) in cachedir,
+  whose parent directory is the cache shared between genomes.
+  '''
+  cacheroot = os.path.dirname(cachedir.rstrip('/'))
+  if not os.path.isdir(cachedir):
+    os.makedirs(cachedir)
+
+  gname = os.path.basename(genome)
+  files = [ (genome + ext, os.path.join(cachedir, gname + ext))
+            for ext in extensions ]
+
+  with open(os.path.join(cacheroot, '.lock'), 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+
+    # Mark this genome as in use before anything is evicted.
+    open(os.path.join(cachedir, STAMP), 'a').close()
+    os.utime(os.path.join(cachedir, STAMP), None)
+    evict_stale(cacheroot, cachedir, max_age)
+
+    stale  = [ (src, dst) for (src, dst) in files if not _is_current(src, dst) ]
+    needed = sum([ os.path.getsize(src) for (src, _dst) in stale ])
+    if not stale:
+      return
+
+    fsstat = os.statvfs(cacheroot)
+    spare  = (fsstat.f_bavail - fsstat.f_blocks * MIN_FREE_FRACTION) * fsstat.f_frsize
+    link   = needed > spare
+    if link:
+      LOGGER.warning("Not enough space in %s to cache %s (%d bytes needed);"
+                     + " linking to the original index files.", cacheroot, genome, needed)
+
+    for (src, dst) in stale:
+      if link and os.path.islink(dst):
+        continue
+      _replace(dst, src, link)
+
+################################################################################
+
+if __name__ == '__main__':
+
+  import argparse
+
+  PARSER = argparse.ArgumentParser(
+    description='Copy a bwa genome index to a node-local cache directory.')
+
+  PARSER.add_argument('genome', metavar='<genome>', type=str,
+                      help='The genome index path, as passed to bwa.')
+
+  PARSER.add_argument('cachedir', metavar='<cache directory>', type=str,
+                      help='The directory in which to cache this genome index.')
+
+  PARSER.add_argument('extensions', metavar='<extension>', type=str, nargs='+',
+                      help='The index file extensions (e.g. .bwt) to cache.')
+
+  PARSER.add_argument('--max-age', type=float, dest='max_age', default=7,
+                      help='Remove other cached genomes unused for this many days.')
+
+  PARSER.add_argument('--loglevel', type=int, dest='loglevel', default=WARNING,
+                      help='The level of logging.')
+
+  ARGS = PARSER.parse_args()
+
+  LOGGER.setLevel(ARGS.loglevel)
+
+  try:
+    cache_index(ARGS.genome, ARGS.cachedir, ARGS.extensions, ARGS.max_age)
+  except (IOError, OSError), err:
+    sys.exit("Unable to cache genome index %s: %s" % (ARGS.genome, err))
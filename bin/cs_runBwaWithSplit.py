@@ -27,75 +27,58 @@ __credits__ = "Originally adjusted from cs_runMaqWithSplit written by Gordon Bro
 # Known bugs: 
 # 
 
-import sys # for processing command line arguments
 import os # for miscellaneous operating system interfaces
-import os.path # for manipulating path
-import re # regular expressions module
-import glob # module for listing filenames with wildcards
-from distutils import spawn
-from pipes import quote
-import time
 
 from osqutil.setup_logs import configure_logging
-from logging import INFO, WARNING
+from logging import INFO
 LOGGER = configure_logging(level=INFO)
     
 from osqutil.cluster import BwaAlignmentManager
+from osqutil.utilities import find_merge_prog
+from osqutil.cli_common import make_split_parser, split_read_count
 
 ##################  M A I N   P R O G R A M  ######################
 
 if __name__ == '__main__':
 
-  import argparse
+  PARSER = make_split_parser()
 
-  PARSER = argparse.ArgumentParser(
-    description='Split a FASTQ file into chunks and align'
-    + ' these chunks in parallel on the cluster.')
-
-  PARSER.add_argument('genome', metavar='<genome>', type=str,
-                      help='The genome against which to align.')
-
-  PARSER.add_argument('files', metavar='<fastq file(s)>', type=str, nargs='+',
-                      help='The fastq files to align.')
-
-  PARSER.add_argument('--algorithm', type=str, dest='algorithm', choices=('aln', 'mem'),
-                      help='The bwa algorithm to use (aln or mem).')
-
-  PARSER.add_argument('--sample', type=str, dest='sample',
-                      help='The sample name used to tag the output bam read group.')
-
-  PARSER.add_argument('--loglevel', type=int, dest='loglevel', default=WARNING,
-                      help='The level of logging.')
-
-  PARSER.add_argument('--reads', type=int, dest='reads', default=1000000,
-                      help='The number of reads in a split.')
-
-  PARSER.add_argument('--rcp', type=str, dest='rcp',
-                      help='Remote file copy (rcp) target.')
+  PARSER.add_argument('--algorithm', type=str, dest='algorithm', choices=('aln', 'mem', 'mem2', 'mem-gpu'),
+                      help='The bwa algorithm to use (aln, mem, mem2 to run bwa-mem2,'
+                      + ' or mem-gpu to run Parabricks fq2bam unsplit on a GPU node).')
 
   PARSER.add_argument('--lcp', type=str, dest='lcp', default=None,
                       help='Local file copy (lcp) target.')
   
-  PARSER.add_argument('--group', type=str, dest='group',
-                      help='The user group for the files.')
-
-  PARSER.add_argument('--cleanup', dest='cleanup', action='store_true',
-                      help='Delete all temporary files.')
-
   PARSER.add_argument('--no-split', dest='nosplit', action='store_true',
                       help='Do not split input fastq for distributed parallel alignment.', default=False)
   
+  PARSER.add_argument('--auto-split-threshold-gb', dest='split_threshold', type=float, default=0,
+                      help='Do not split inputs whose combined size is below this many GB,'
+                      + ' as the split/merge overhead outweighs the gain. The default (0)'
+                      + ' always splits.')
+
   PARSER.add_argument('--n_occ', dest='nocc', type=str,
                       help='Number of occurrences of non-unique reads to keep.')
 
   PARSER.add_argument('--fileshost', dest='fileshost', type=str,
                       help='Host where the files should be downloaded from.')
   
-  PARSER.add_argument('-d', '--debug', dest='debug', action='store_true',
-                      help='Turn on debugging output.')
-
   ARGS = PARSER.parse_args()
 
+  if ARGS.bases is not None and ARGS.fileshost is not None:
+    PARSER.error("--bases requires local input files; use --reads with --fileshost.")
+  ARGS.reads = split_read_count(ARGS)
+
+  # Small inputs align faster on a single multithreaded node. Input
+  # size can only be checked when the files are already local.
+  if not ARGS.nosplit and ARGS.split_threshold > 0 and ARGS.fileshost is None:
+    total_size = sum([ os.path.getsize(fname) for fname in ARGS.files ])
+    if total_size < ARGS.split_threshold * 1024**3:
+      LOGGER.info("Input size %d bytes is below the split threshold; not splitting.",
+                  total_size)
+      ARGS.nosplit = True
+
   # Finding cs_runBwaWithSplit_Merge.py on this PATH is okay, since
   # we're typically running on the cluster under the path defined in
   # osqutil.config
@@ -107,8 +90,7 @@ if __name__ == '__main__':
                              nocc       = ARGS.nocc,
                              bwa_algorithm = ARGS.algorithm,
                              nosplit      = ARGS.nosplit,
-                             merge_prog = spawn.find_executable('cs_runBwaWithSplit_Merge.py',
-                                                                path=os.environ['PATH']))
+                             merge_prog = find_merge_prog())
 
   BSUB.split_and_align(files      = ARGS.files,
                        genome     = ARGS.genome,
@@ -27,11 +27,6 @@ __credits__ = "Adjusted from cs_runMaqWithSplit_Merge written by Gordon Brown."
 # Known bugs: 
 # 
 
-import sys
-import os
-import os.path
-import re
-
 from osqutil.setup_logs import configure_logging
 from logging import INFO, WARNING
 LOGGER = configure_logging(level=INFO)
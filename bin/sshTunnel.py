@@ -28,8 +28,35 @@ if possible we should try and keep it that way.
 """
 
 import os
-from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM
-from syslog import syslog, LOG_ERR, LOG_INFO, LOG_WARNING
+import re
+import sys
+import getpass
+import atexit
+import base64
+import zlib
+import ctypes
+from ctypes.util import find_library
+import select
+import subprocess
+import time
+import socket as socketlib
+from socket import socket, error as SocketError, AF_INET, SOCK_STREAM, \
+    SOL_SOCKET, SO_KEEPALIVE, SO_ERROR, IPPROTO_TCP, SOCK_DGRAM
+
+# These are only needed to set the tunnels up; the copy of this script
+# run on the remote host with --revpoll can do without them.
+try:
+  import pexpect
+except ImportError:
+  pexpect = None
+try:
+  import daemon
+except ImportError:
+  daemon = None
+try:
+  import netifaces
+except ImportError:
+  netifaces = None
 
 # Required for OneWayTunnel:
 LOCAL_SSH_PORT       = 22000 # opens on localhost, connects to remote host port 22
@@ -43,10 +70,25 @@ LOCAL_SQL_PORT       = 5432
 REMOTE_HTTPS_PORT    = 22443 # opens on remote host, connects to localhost:LOCAL_HTTPS_PORT
 REMOTE_SQL_PORT      = 25432 # opens on remote host, connects to localhost:LOCAL_SQL_PORT
 
+# Have ssh itself exit when the link breaks (no reply to three
+# keepalives 30s apart) or a forward cannot be set up, so that
+# child.isalive() reflects the state of the tunnel.
+SSH_KEEPALIVE_FLAGS = ['-o', 'ServerAliveInterval=30', '-o', 'ServerAliveCountMax=3',
+                       '-o', 'ExitOnForwardFailure=yes', '-o', 'TCPKeepAlive=yes']
+
+# Prompts matched in the ssh session; compiled once rather than by
+# pexpect on every (re)connection.
+PASSWORD_PROMPT   = re.compile('password:')
+PASSWORD_REFUSED  = re.compile('Permission denied')
+PASSPHRASE_PROMPT = re.compile('Enter passphrase for key')
+
 # FIXME make sure the squid proxy 3128:webcache.sanger.ac.uk:3128
 # forwarding is in ~/.ssh/config prior to deploying this.
 
-from logging import getLogger, StreamHandler, DEBUG  # For test mode only.
+# Messages go to the console until the daemon detaches, after which
+# log_to_syslog sends them to the system log instead.
+from logging import getLogger, StreamHandler, Formatter, DEBUG
+from logging.handlers import SysLogHandler
 LOGGER = getLogger()
 LOGGER.addHandler(StreamHandler())
 LOGGER.setLevel(DEBUG)
@@ -58,47 +100,283 @@ LOGGER.setLevel(DEBUG)
 # Below is one of the method from stackoverflow discussion which seems to have
 # robustness to an extent.
 # http://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib
+_LOCAL_IP = None
+
+def _get_iface_ip():
+  '''
+  Return the first non-loopback IPv4 address known to netifaces, or
+  None if netifaces is unavailable or finds nothing suitable.
+  '''
+  if netifaces is None:
+    return None
+  for iface in netifaces.interfaces():
+    for addr in netifaces.ifaddresses(iface).get(netifaces.AF_INET, []):
+      ip = addr.get('addr')
+      if ip and not ip.startswith('127.'):
+        return ip
+  return None
+
 def get_ip():
-  s = socket(AF_INET, SOCK_DGRAM)
-  try:
-    # doesn't even have to be reachable
-    s.connect(('10.255.255.255', 0))
-    IP = s.getsockname()[0]
-  except:
-    IP = '127.0.0.1'
-  finally:
-    s.close()
+  global _LOCAL_IP
+  if _LOCAL_IP is not None:
+    return _LOCAL_IP
+
+  IP = _get_iface_ip()
+  if IP is None:
+    s = socket(AF_INET, SOCK_DGRAM)
+    try:
+      # doesn't even have to be reachable
+      s.connect(('10.255.255.255', 0))
+      IP = s.getsockname()[0]
+    except:
+      IP = '127.0.0.1'
+    finally:
+      s.close()
+
+  _LOCAL_IP = IP
   return IP
 
-def kill(child, errstr='', test_mode=False):
+def log_to_syslog():
 
-  '''Kill a pexpect process and send details to the syslog and stdout.'''
+  '''Send all further LOGGER messages to the system log rather than
+  the console. Called once the daemon has detached from the tty.'''
 
-  if not test_mode:
-    syslog(LOG_ERR, errstr)
-    syslog(LOG_ERR, child.before)
-    syslog(LOG_ERR, child.after)
-  else:
-    LOGGER.error(errstr)
-    LOGGER.error(child.before)
-    LOGGER.error(child.after)
+  for handler in LOGGER.handlers[:]:
+    LOGGER.removeHandler(handler)
+  try:
+    handler = SysLogHandler(address='/dev/log')
+  except SocketError: # No local syslog socket; fall back to UDP.
+    handler = SysLogHandler()
+  handler.setFormatter(Formatter('%s: %%(message)s' % os.path.basename(sys.argv[0])))
+  LOGGER.addHandler(handler)
+
+def kill(child, errstr=''):
+
+  '''Kill a pexpect process and send details to the log.'''
+
+  LOGGER.error(errstr)
+  LOGGER.error(child.before)
+  LOGGER.error(child.after)
   child.terminate(True)
   exit(1)
 
+def key_needs_passphrase(identity_file):
+
+  '''Return True unless the private key in identity_file can be read
+  with an empty passphrase, so that we only prompt when it is really
+  needed.'''
+
+  with open(os.devnull, 'w') as null:
+    rc = subprocess.call(['ssh-keygen', '-y', '-P', '', '-f', identity_file],
+                         stdout=null, stderr=null)
+  return rc != 0
+
+def lock_secret(secret):
+
+  '''Lock the buffer of a bytearray holding a password into memory
+  via mlock(2), so that it is never written to swap, and arrange for
+  it to be zeroed on exit. Memory locks are not inherited across fork,
+  so this must be called from the process which will keep the
+  secret (i.e., after daemonising).'''
+
+  if not secret: # Also covers key/agent authentication (None).
+    return
+
+  buf = (ctypes.c_char * len(secret)).from_buffer(secret)
+  try:
+    libc = ctypes.CDLL(find_library('c'), use_errno=True)
+    libc.mlock(ctypes.addressof(buf), len(secret))
+  except (OSError, AttributeError):
+    pass # Not fatal; the secret just isn't pinned.
+
+  def _wipe():
+    secret[:] = '\0' * len(secret)
+  atexit.register(_wipe)
+
+def _open_probe(port):
+
+  '''Open a connection to the tunnelled port on localhost with TCP
+  keepalive enabled, so that the kernel itself notices a half-open
+  connection. Returns None if the connection is refused.'''
+
+  sock = socket(AF_INET, SOCK_STREAM)
+  if sock.connect_ex(('127.0.0.1', port)) != 0:
+    sock.close()
+    return None
+
+  sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+
+  # The finer-grained settings are Linux-specific; TCP_USER_TIMEOUT
+  # is missing from the python 2 socket module, so we supply the
+  # Linux value ourselves.
+  if sys.platform.startswith('linux'):
+    for (name, default, value) in (('TCP_KEEPIDLE',     4,  30),
+                                   ('TCP_KEEPINTVL',    5,  10),
+                                   ('TCP_KEEPCNT',      6,  3),
+                                   ('TCP_USER_TIMEOUT', 18, 45000)):
+      sock.setsockopt(IPPROTO_TCP, getattr(socketlib, name, default), value)
+
+  return sock
+
+def _wait_for_disconnect(sock, timeout=60, fds=()):
+
+  '''Block until the probe connection sock is dropped or timeout
+  seconds have passed, so that a dying tunnel is noticed at once
+  rather than on the next polling cycle. Uses epoll where available
+  (Linux), falling back to poll; a timeout of None waits
+  indefinitely. Returns True if the connection is still up, False
+  otherwise. Also returns True early if any of the
+  optional file descriptors fds (e.g. the ptys of our ssh processes)
+  reaches end-of-file, so that the caller can check on those
+  processes.'''
+
+  if sock.getsockopt(SOL_SOCKET, SO_ERROR) != 0:
+    return False
+
+  # EPOLLRDHUP (peer shutdown) is missing from the python 2 select
+  # module, so we supply the Linux value ourselves.
+  if hasattr(select, 'epoll'):
+    poller = select.epoll()
+    hangup = select.EPOLLHUP | select.EPOLLERR | getattr(select, 'EPOLLRDHUP', 0x2000)
+    readable = select.EPOLLIN
+    scale  = 1     # epoll timeouts are in seconds.
+  else:
+    poller = select.poll()
+    hangup = select.POLLHUP | select.POLLERR
+    readable = select.POLLIN
+    scale  = 1000  # poll timeouts are in milliseconds.
+  for fd in [ sock.fileno() ] + list(fds):
+    poller.register(fd, readable | hangup)
+
+  try:
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      if deadline is None:
+        wait = -1 # Both epoll and poll block on a negative timeout.
+      else:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return True
+        wait = remaining * scale
+      for (fd, event) in poller.poll(wait):
+
+        # Output from ssh is of no interest; discard it.
+        if fd != sock.fileno():
+          try:
+            if event & hangup or os.read(fd, 4096) == '':
+              return True
+          except OSError: # EIO on a closed pty.
+            return True
+          continue
+
+        try:
+          closed = event & hangup or sock.recv(4096) == ''
+        except SocketError:
+          closed = True
+        if closed:
+          return False
+
+        # Otherwise the far end sent us something (e.g. an SSH
+        # banner); discard it and keep waiting.
+  finally:
+    if hasattr(poller, 'close'):
+      poller.close()
+
+def _watch_port(port, sock=None, timeout=60, fds=()):
+
+  '''Watch the tunnelled port for up to timeout seconds through the
+  cached probe connection sock, opening one if necessary. Returns the
+  probe connection to pass in on the next call, or None if the tunnel
+  is down. See _wait_for_disconnect for fds.'''
+
+  if sock is None:
+    return _open_probe(port)
+
+  if _wait_for_disconnect(sock, timeout, fds):
+    return sock
+
+  # The far end may just have dropped an idle connection (e.g. sshd
+  # LoginGraceTime), so only report a failure if a fresh connection
+  # is also refused.
+  sock.close()
+  return _open_probe(port)
+
 def poll_reverse_tunnel():
 
-  '''Periodically ensure that the reverse tunnel is up and
-  running. Returns upon loss of connection. This is used by a copy of
-  this script running on the remote host.'''
+  '''Ensure that the reverse tunnel is up and running. Returns upon
+  loss of connection. This is used by a copy of this script running
+  on the remote host. There is nothing else for this process to do,
+  so it sleeps in the kernel until the probe connection drops (TCP
+  keepalive covers half-open links).'''
+
+  sock = _watch_port(REMOTE_SSH_PORT)
+  while sock is not None:
+    sock = _watch_port(REMOTE_SSH_PORT, sock, timeout=None)
+
+def _reverse_poll_command(scriptfile):
 
-  import time
+  '''Return a remote shell command which runs scriptfile with the
+  --revpoll option. The script body is passed compressed on the
+  command line, so the reverse tunnel is set up by a single ssh
+  session with nothing written to disk on the remote host.'''
 
-  while(1):
-    sock = socket(AF_INET, SOCK_STREAM)
-    res  = sock.connect_ex(('127.0.0.1', REMOTE_SSH_PORT))
-    if res != 0: # Connection has failed.
-      return
-    time.sleep(60)
+  with open(scriptfile, 'rb') as script:
+    body = base64.b64encode(zlib.compress(script.read(), 9))
+
+  return ("python -c 'import sys, zlib, base64;"
+          " exec(zlib.decompress(base64.b64decode(sys.argv.pop(1))))'"
+          " %s --revpoll" % body)
+
+##############################################################################
+
+class BatchSSH(object):
+
+  '''Stand-in for pexpect.spawn where ssh needs no prompts answering
+  (key or agent authentication). Runs the command directly rather
+  than under a pty, providing just the parts of the pexpect interface
+  used here. child_fd is the read end of ssh's output pipe, which
+  reaches end-of-file when ssh exits. The input pipe is held open so
+  that a session without -N is not ended by an immediate EOF.'''
+
+  def __init__(self, argv):
+    self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 close_fds=True)
+    self.child_fd = self.proc.stdout.fileno()
+    self.before = ''
+    self.after  = ''
+
+  def wait_for_exit(self, timeout):
+
+    '''Wait up to timeout seconds for ssh to exit, keeping what it
+    said in self.before. Returns True if it has exited.'''
+
+    output   = []
+    deadline = time.time() + timeout
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0 or not select.select([self.child_fd], [], [], remaining)[0]:
+        return False
+      data = os.read(self.child_fd, 4096)
+      if data == '':
+        self.before = ''.join(output)
+        self.proc.wait()
+        return True
+      output.append(data)
+
+  def isalive(self):
+    return self.proc.poll() is None
+
+  def terminate(self, force=False):
+    if self.isalive():
+      self.proc.terminate()
+      self.proc.wait()
+    return True
+
+  def close(self, force=True):
+    self.terminate(force)
+    self.proc.stdin.close()
+    self.proc.stdout.close()
 
 ##############################################################################
 
@@ -107,70 +385,108 @@ class OneWayTunnel(object):
   '''Class to connect to a remote host and forward ports from target
   machines back to our local host.'''
 
-  def __init__(self, remote_hostname, identity_file=None, test_mode=False):
-
-    import getpass
-
-    # Password stored in memory but slightly obfuscated; potential
-    # security issue e.g. from core dumps/memory scan. Given that we
-    # don't know how the pexpect code might cache the (decoded) values
-    # sent to it, this seems like it might be a little pointless.
-    self.gate_username = raw_input('Gateway Host Username: ').encode('base64')
-    if identity_file is None:
-      self.gate_password = getpass.getpass('Gateway Host Password: ').encode('base64')
+  def __init__(self, remote_hostname, identity_file=None, test_mode=False, use_agent=False):
+
+    # Passwords are held in bytearrays which are mlocked and zeroed
+    # on exit by lock_secret (see connect). Note that the original
+    # strings, and whatever pexpect does with the values sent to it,
+    # are beyond our control.
+    # With use_agent, authentication is left to ssh-agent or an
+    # unencrypted key, and no passwords are requested at all (None).
+    # An unencrypted identity_file is likewise used without a prompt.
+    self.use_agent = use_agent
+    self.gate_username = raw_input('Gateway Host Username: ')
+    if use_agent:
+      self.gate_password = None
+    elif identity_file is not None and os.path.isfile(identity_file) \
+          and not key_needs_passphrase(identity_file):
+      self.gate_password = None
+    elif identity_file is None:
+      self.gate_password = bytearray(getpass.getpass('Gateway Host Password: '))
     else:
-      self.gate_password = getpass.getpass('Gateway Identity File Password: ').encode('base64')
+      self.gate_password = bytearray(getpass.getpass('Gateway Identity File Password: '))
 
     # Visible to subclasses, however they're unlikely to need access.
     self.child = None
 
+    # Cached connection used to check that the tunnel is up.
+    self._probe_sock = None
+
     self.identity_file_login = False
     # N.B. we could add additional tunnels to this command, e.g. port
     # 22 for rsync. Often this will be better put in the ~/.ssh/config
     # file though.
     if identity_file is None:      
-      self.ssh_flags = '-C -N -L %d:%s:22' % (LOCAL_SSH_PORT, remote_hostname)
+      self.ssh_flags = SSH_KEEPALIVE_FLAGS + [ '-C', '-N', '-L', '%d:%s:22' % (LOCAL_SSH_PORT, remote_hostname) ]
     else:
       if os.path.isfile(identity_file):
         # NB! We omit -N flag here because it causes ssh to hang while connecting to stargate.ebi.ac.uk with identity_file specified.
-        self.ssh_flags = '-i %s -C -L %d:%s:22' % (identity_file, LOCAL_SSH_PORT, remote_hostname)
+        self.ssh_flags = SSH_KEEPALIVE_FLAGS + [ '-i', identity_file, '-C', '-L', '%d:%s:22' % (LOCAL_SSH_PORT, remote_hostname) ]
       else:
-        if not test_mode:
-          syslog(LOG_ERR, 'Identity file not found!')
-        else:
-          LOGGER.error('Identity file not found!')
+        LOGGER.error('Identity file not found!')
         exit(1)
       self.identity_file_login = True
       
     self.test_mode = test_mode
 
-  def _start_tunnel(self, host, username, password, ssh_flags='', remote_command='', forward_tunnel=True):
+  def _start_tunnel(self, host, username, password, ssh_flags=(), remote_command=None, forward_tunnel=True):
 
     '''Given a host, username and password, connect to that host using
     the settings in ssh_flags to control the creation of an SSH
-    tunnel.'''
+    tunnel. A password of None means key or agent authentication, in
+    which case ssh is run in batch mode and never prompts.'''
+
+    # Arguments are passed to ssh as a list, so nothing here is
+    # subject to word splitting.
+    args = list(ssh_flags) + [ '%s@%s' % (username, host) ]
+    if remote_command:
+      args.append(remote_command)
+
+    if password is None:
+      child = BatchSSH([ 'ssh', '-o', 'BatchMode=yes' ] + args)
 
-    import pexpect
-    import time
+      # With -N (or --revpoll) ssh stays quiet once connected, so we
+      # can only tell success by its not exiting.
+      if child.wait_for_exit(10):
+        kill(child, 'SSH key authentication failed. Here is what SSH said:')
+      return child
 
     if self.identity_file_login and forward_tunnel:
-      expect_password = 'Enter passphrase for key'
-      expect_password_failed = 'Enter passphrase for key'
+      expect_password = PASSPHRASE_PROMPT
+      expect_password_failed = PASSPHRASE_PROMPT
     else:
-      expect_password = 'password:'
-      expect_password_failed = 'Permission denied'
+      expect_password = PASSWORD_PROMPT
+      expect_password_failed = PASSWORD_REFUSED
       
-    child = pexpect.spawn("ssh %s %s@%s %s" % (ssh_flags, username, host, remote_command))
+    child = pexpect.spawn('ssh', args)
     i = child.expect([pexpect.TIMEOUT, expect_password])
     if i == 0:
-      kill(child, 'SSH timed out. Here is what SSH said:', self.test_mode)
-    time.sleep(0.1)
-    child.sendline(password)
+      kill(child, 'SSH timed out. Here is what SSH said:')
+    child.sendline(str(password))
     i = child.expect([pexpect.TIMEOUT, expect_password_failed])
     if i == 1:
-      kill(child, 'Incorrect password. Here is what SSH said:', self.test_mode)
+      kill(child, 'Incorrect password. Here is what SSH said:')
     return child
 
+  def _restart_tunnel(self, attr, name, *args, **kwargs):
+
+    '''(Re)start an SSH tunnel, storing the new pexpect process in
+    self.<attr>. Further arguments are passed on to _start_tunnel; name
+    is used for logging. Returns True on success, False otherwise.'''
+
+    LOGGER.warning('Restarting %s' % name)
+
+    try:
+      setattr(self, attr, self._start_tunnel(*args, **kwargs))
+      LOGGER.info('%s established' % name)
+
+    except Exception, err:
+
+      LOGGER.error(str(err))
+      return False
+
+    return True
+
   def _confirm_tunnel_open(self, host):
 
     '''Confirms that the SSH tunnel is running and at least basically
@@ -185,50 +501,29 @@ class OneWayTunnel(object):
     # first loop iteration.
     if self.child is None or not self.child.isalive():
 
-      mess = 'Restarting SSH tunnel'
-      if not self.test_mode:
-        syslog(LOG_WARNING, mess)
-      else:
-        LOGGER.warning(mess)
-        
-      try:
-        self.child = self._start_tunnel(host,
-                                        self.gate_username.decode('base64'),
-                                        self.gate_password.decode('base64'),
-                                        self.ssh_flags)
-        mess = 'SSH tunnel established'
-        if not self.test_mode:
-          syslog(LOG_INFO, mess)
-        else:
-          LOGGER.info(mess)
-          
-      except Exception, err:
-
-        if not self.test_mode:
-          syslog(LOG_ERR, str(err))
-        else:
-          LOGGER.error(str(err))
-          
-        rc = False
+      # Any probe connection went through the old ssh process.
+      if self._probe_sock is not None:
+        self._probe_sock.close()
+        self._probe_sock = None
 
-    else:
+      rc = self._restart_tunnel('child', 'SSH tunnel', host,
+                                self.gate_username,
+                                self.gate_password,
+                                self.ssh_flags)
 
-      # Confirm that the connection is actually running.
-      sock = socket(AF_INET, SOCK_STREAM)
+    else:
 
-      # This line means we always need some known port forwarding
+      # Confirm that the connection is actually running, holding a
+      # probe connection open until it drops or the next check is
+      # due. This means we always need some known port forwarding
       # encoded directly in this script; other ports can be
-      # configured in ~/.ssh/config. In this case we use the squid
-      # webcache port.
-      res  = sock.connect_ex(('127.0.0.1', LOCAL_SSH_PORT))
+      # configured in ~/.ssh/config.
+      self._probe_sock = _watch_port(LOCAL_SSH_PORT, self._probe_sock, fds=self._ssh_fds())
 
-      if res != 0: # Connection has mysteriously failed.
+      if self._probe_sock is None: # Connection has mysteriously failed.
 
         mess = 'Shutting down link upon unexplained connection failure'
-        if not self.test_mode:
-          syslog(LOG_WARNING, mess)
-        else:
-          LOGGER.warning(mess)
+        LOGGER.warning(mess)
 
         # FIXME could also consider child.terminate below, if
         # child.close generates zombie processes.
@@ -237,14 +532,24 @@ class OneWayTunnel(object):
 
     return rc
 
+  def _ssh_fds(self):
+
+    '''File descriptors of the running ssh processes, watched while
+    waiting on the tunnel so that a dying process is noticed at once.'''
+
+    return [ self.child.child_fd ]
+
+  def _lock_secrets(self):
+
+    '''Pin the stored passwords in memory (see lock_secret).'''
+
+    lock_secret(self.gate_password)
+
   def connect(self, host):
 
     '''Start a background daemon which sets up the SSH tunnel and
     monitors it, restarting whenever necessary.'''
 
-    import daemon
-    import time
-    
     if not self.test_mode:
 
       print "Starting daemon for SSH tunnel to %s..." % host
@@ -252,17 +557,19 @@ class OneWayTunnel(object):
 
         # From here on in, we have no access to stdout/stderr to inform
         # the user of problems.
+        log_to_syslog()
+        self._lock_secrets()
+
+        # _confirm_tunnel_open blocks while the tunnel is healthy,
+        # so there is no need to sleep between checks.
         while True:
-          rc = self._confirm_tunnel_open(host)
-          if rc:  # Don't hang around if there's a problem.
-            time.sleep(60)
+          self._confirm_tunnel_open(host)
 
     else: # Test mode; don't detach from console.
       print "Running SSH tunnel under test mode to %s..." % host
+      self._lock_secrets()
       while True:
-        rc = self._confirm_tunnel_open(host)
-        if rc:  # Don't hang around if there's a problem.
-          time.sleep(60)
+        self._confirm_tunnel_open(host)
         
 ##############################################################################
 
@@ -273,77 +580,64 @@ class TwoWayTunnel(OneWayTunnel):
 
   def __init__(self, remote_dir='.', localhost_ip=None, rep_tunnels=False, *args, **kwargs):
 
-    import getpass
-    
     super(TwoWayTunnel, self).__init__(*args, **kwargs)
 
     print "\nLeave Remote details blank if the same as the Gateway login account:"
     username = raw_input('  Remote Host Username: ')
-    password = getpass.getpass('  Remote Host Password: ')
+    password = '' if self.use_agent else getpass.getpass('  Remote Host Password: ')
 
     if (len(username) == 0):
       self.remote_username = self.gate_username
     else:
-      self.remote_username = username.encode('base64')
+      self.remote_username = username
 
     if (len(password) == 0):
       self.remote_password = self.gate_password
     else:
-      self.remote_password = password.encode('base64')
+      self.remote_password = bytearray(password)
 
     self.grandchild = None
-    self.remote_dir = remote_dir
 
     if localhost_ip is None:
       localhost_ip = get_ip()
       mess = 'Local IP: %s' % localhost_ip
-      if not self.test_mode:
-        syslog(LOG_INFO, mess)
-      else:
-        LOGGER.info(mess)
+      LOGGER.info(mess)
     
-    # Need to grab this before the daemon detaches from the tty.
-    self.local_dir  = os.getcwd()
+    # Need to read this before the daemon changes directory. The
+    # remote_dir argument is no longer needed and is ignored.
+    self.reverse_command = _reverse_poll_command(__file__)
 
     # Add reverse tunnel flags for repository support: port 443 (https) and port 5432 (PostgreSQL)
-    rep_tunnel_str = ''
+    rep_tunnel_flags = []
     if rep_tunnels:
-      rep_tunnel_str = ' -R %s:%s:%s -R %s:%s:%s' % (REMOTE_HTTPS_PORT, localhost_ip, LOCAL_HTTPS_PORT, REMOTE_SQL_PORT, localhost_ip, LOCAL_SQL_PORT)
+      rep_tunnel_flags = [ '-R', '%s:%s:%s' % (REMOTE_HTTPS_PORT, localhost_ip, LOCAL_HTTPS_PORT),
+                           '-R', '%s:%s:%s' % (REMOTE_SQL_PORT, localhost_ip, LOCAL_SQL_PORT) ]
 
     # For forwarding other ports, e.g. https port 443, look into the
     # ~/.ssh/config file using host-specific RemoteForward
     # directives. Note that we omit the -N option here because we want
     # to run a script on the remote host to check for port integrity.
-    self.reverse_ssh_flags = '-p %d -C -R %d:%s:22%s' % (LOCAL_SSH_PORT, REMOTE_SSH_PORT, localhost_ip, rep_tunnel_str)
+    self.reverse_ssh_flags = SSH_KEEPALIVE_FLAGS + [ '-p', str(LOCAL_SSH_PORT), '-C',
+                                                '-R', '%d:%s:22' % (REMOTE_SSH_PORT, localhost_ip) ] \
+                                                + rep_tunnel_flags
 
-  def _scp_script_remote(self):
+  def _ssh_fds(self):
 
-    '''Copies this script to the target path on the server.'''
+    '''As OneWayTunnel._ssh_fds, adding the reverse tunnel's ssh
+    process so that both directions are watched at once.'''
 
-    import pexpect
+    fds = super(TwoWayTunnel, self)._ssh_fds()
+    if self.grandchild is not None and self.grandchild.isalive():
+      fds.append(self.grandchild.child_fd)
+    return fds
 
-    scriptfile = os.path.join(self.local_dir, __file__)
-    cmd = ('scp -P %d %s %s@127.0.0.1:%s/.'
-           % (LOCAL_SSH_PORT, scriptfile,
-              self.remote_username.decode('base64'), self.remote_dir))
+  def _lock_secrets(self):
 
-    mess = 'Copying SSH tunnel script to remote server (%s).' % cmd
-    if not self.test_mode:
-      syslog(LOG_WARNING, mess)
-    else:
-      mess += ": %s" % cmd
-      LOGGER.info(mess)
-      
-    child = pexpect.spawn(cmd)
-    i = child.expect(['assword:', r"yes/no"], timeout=30)
-    if i == 0:
-      child.sendline(self.remote_password.decode('base64'))
-    elif i == 1:
-      child.sendline("yes")
-      child.expect("assword:", timeout=30)
-      child.sendline(self.remote_password.decode('base64'))
-    data = child.read()
-    child.close()
+    '''Pin the stored passwords in memory (see lock_secret).'''
+
+    super(TwoWayTunnel, self)._lock_secrets()
+    if self.remote_password is not self.gate_password:
+      lock_secret(self.remote_password)
 
   def _confirm_tunnel_open(self, *args, **kwargs):
 
@@ -356,43 +650,18 @@ class TwoWayTunnel(OneWayTunnel):
     # Confirm that the reverse tunnel is running.
     if rc:
 
-      # First run through, copy this script to the remote server.
-      if self.grandchild is None:
-        self._scp_script_remote()
-
       # Set up the reverse tunnel here. We need an SSH session going
       # out to the remote host over the previously-established tunnel to
-      # the gateway host. We then run a copy of this script on the remote host
-      # with the --revpoll option to check that the forwarded port
+      # the gateway host. We then run this script on the remote host,
+      # passed in the ssh command itself, with the --revpoll option to check that the forwarded port
       # link is maintained.
       if self.grandchild is None or not self.grandchild.isalive():
 
-        mess = 'Restarting SSH reverse tunnel'
-        if not self.test_mode:
-          syslog(LOG_WARNING, mess)
-        else:
-          LOGGER.warning(mess)
-          
-        try:
-          self.grandchild = self._start_tunnel('127.0.0.1',
-                                               self.remote_username.decode('base64'),
-                                               self.remote_password.decode('base64'),
-                                               self.reverse_ssh_flags,
-                                               os.path.join(self.remote_dir, os.path.basename(__file__)) + ' --revpoll', forward_tunnel=False)
-          mess = 'SSH reverse tunnel established'
-          if not self.test_mode:
-            syslog(LOG_INFO, mess)
-          else:
-            LOGGER.info(mess)
-            
-        except Exception, err:
-
-          if not self.test_mode:
-            syslog(LOG_ERR, str(err))
-          else:
-            LOGGER.error(str(err))
-            
-          rc = False
+        rc = self._restart_tunnel('grandchild', 'SSH reverse tunnel', '127.0.0.1',
+                                  self.remote_username,
+                                  self.remote_password,
+                                  self.reverse_ssh_flags,
+                                  self.reverse_command, forward_tunnel=False)
       
     return rc
 
@@ -423,8 +692,8 @@ if __name__ == '__main__':
                          + ' not be invoked manually. Exits upon connection failure.')
 
   PARSER.add_argument('-d', '--remotedir', dest='remdir', type=str, default='.',
-                      help='The directory on the remote machine into which this script'
-                         + ' will be copied. Two-way tunnels only.')
+                      help='Ignored; retained for compatibility. The polling script is'
+                         + ' now passed over the ssh connection rather than copied.')
 
   PARSER.add_argument('--gateway-host', dest='gateway', type=str, default='ssh.sanger.ac.uk',
                       help='The gateway SSH host (default: ssh.sanger.ac.uk).')
@@ -446,6 +715,10 @@ if __name__ == '__main__':
                       default=None,
                       help='IP of the local host (default: autodetect local IP)')
 
+  PARSER.add_argument('--agent', dest='agent', action='store_true',
+                      help='Authenticate using ssh-agent or unencrypted keys only; no'
+                         + ' passwords are requested or held in memory.')
+
   PARSER.add_argument('--testmode', dest='testmode', action='store_true',
                       help='Run the script in test mode. This will prevent the script'
                          + ' from detaching from the console as a daemon, and produce'
@@ -471,10 +744,10 @@ if __name__ == '__main__':
   if ARGS.twoway:
     print "Setting up a Two-way tunnel to the remote host."
     TUNNEL = TwoWayTunnel(remote_hostname=ARGS.remote, identity_file=ARGS.identity,
-                          test_mode=ARGS.testmode,
+                          test_mode=ARGS.testmode, use_agent=ARGS.agent,
                           remote_dir=ARGS.remdir, localhost_ip=ARGS.localhost_ip, rep_tunnels=ARGS.rep_tunnels)
   else:
     print "Setting up a One-way tunnel to the remote host."
     TUNNEL = OneWayTunnel(remote_hostname=ARGS.remote, identity_file=ARGS.identity,
-                          test_mode=ARGS.testmode)
+                          test_mode=ARGS.testmode, use_agent=ARGS.agent)
   TUNNEL.connect(ARGS.gateway)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''Command-line argument handling shared by the cs_run*WithSplit.py
+alignment wrapper scripts.'''
+
+import argparse
+from logging import WARNING
+
+from .utilities import parse_base_count, reads_for_bases
+
+def make_split_parser():
+  '''
+  Return an ArgumentParser preloaded with the arguments common to all
+  the split-and-align wrapper scripts. Aligner-specific arguments can
+  then be added by the caller.
+  '''
+  parser = argparse.ArgumentParser(
+    description='Split a FASTQ file into chunks and align'
+    + ' these chunks in parallel on the cluster.')
+
+  parser.add_argument('genome', metavar='<genome>', type=str,
+                      help='The genome against which to align.')
+
+  parser.add_argument('files', metavar='<fastq file(s)>', type=str, nargs='+',
+                      help='The fastq files to align.')
+
+  parser.add_argument('--sample', type=str, dest='sample',
+                      help='The sample name used to tag the output bam read group.')
+
+  parser.add_argument('--loglevel', type=int, dest='loglevel', default=WARNING,
+                      help='The level of logging.')
+
+  splitsize = parser.add_mutually_exclusive_group()
+  splitsize.add_argument('--reads', type=int, dest='reads', default=1000000,
+                         help='The number of reads in a split.')
+
+  splitsize.add_argument('--bases', type=parse_base_count, dest='bases',
+                         help='The number of bases in a split (e.g. 500M, 2G), in place'
+                         + ' of --reads. Useful where read lengths vary between runs.')
+
+  parser.add_argument('--rcp', type=str, dest='rcp',
+                      help='Remote file copy (rcp) target.')
+
+  parser.add_argument('--group', type=str, dest='group',
+                      help='The user group for the files.')
+
+  parser.add_argument('--cleanup', dest='cleanup', action='store_true',
+                      help='Delete all temporary files.')
+
+  parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                      help='Turn on debugging output.')
+
+  return parser
+
+def split_read_count(args):
+  '''
+  Return the number of reads per split given the parsed arguments,
+  converting from --bases where that was used. Input files must be
+  local for the conversion.
+  '''
+  if args.bases is not None:
+    return reads_for_bases(args.files[0], args.bases)
+  return args.reads
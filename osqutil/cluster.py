@@ -27,28 +27,77 @@ external module dependencies).
 import sys
 import os
 import re
+import base64
 import logging
-import glob
-import tempfile
-import uuid
-from subprocess import Popen, PIPE
+import itertools
+from subprocess import Popen, PIPE, CalledProcessError
+from socket import gethostname
 import time
+import threading
 
-from pipes import quote
+try:
+  from shlex import quote # Python 3.3+; pipes is removed in 3.13.
+except ImportError:
+  from pipes import quote
 from tempfile import gettempdir
 from shutil import move
 
 from osqutil.utilities import call_subprocess, bash_quote, \
     is_zipped, is_bzipped, set_file_permissions, BamPostProcessor, \
-    parse_repository_filename, write_to_remote_file
+    parse_repository_filename, write_to_remote_file, transfer_slot, \
+    backoff_delay, RSYNC_SSH, SSH_MUX_OPTS, which
 
 from osqutil.config import Config
 
 from osqutil.setup_logs import configure_logging
 LOGGER = configure_logging('osqutil.cluster')
 
+# Patterns compiled once at import rather than per call.
+LANE_PATTERN = re.compile(r'^(.*)p[12](@\d+)?$')
+
+JOBID_PATTERNS = {
+  'LSF'   : re.compile(r"Job\s+<(\d+)>\s+is\s+submitted\s+to"),
+  'SLURM' : re.compile(r"Submitted batch job (\d+)"),
+}
+
+JOB_CANCEL_COMMANDS = {
+  'LSF'   : 'bkill',
+  'SLURM' : 'scancel',
+}
+
+# Prefix of the last output line of a submit_job_chain command, giving
+# the exit status of the chained submissions.
+CHAIN_STATUS_TAG = '__SUBMIT_STATUS__='
+
+# The maximum number of concurrent scp sessions in remote_copy_files.
+MAX_SCP_THREADS = 8
+
+# Names for files this process writes to shared cluster directories
+# (sbatch script copies, job array command files). The host name and
+# process start time (plus the pid added per call) keep names from
+# different processes apart; the counter does the same for files
+# within a process.
+PROCESS_TAG        = '%s-%d' % (gethostname(), int(time.time()))
+FILE_COUNTER       = itertools.count()
+SLURM_FILE_PREFIX  = 'sbatch-' + PROCESS_TAG
+
+# The files making up a genome index, as cached on compute nodes by
+# CACHE_INDEX_PROG (see BwaAlignmentManager._cache_index).
+BWA_INDEX_EXTENSIONS = {
+  'mem'  : ('.amb', '.ann', '.bwt', '.pac', '.sa'),
+  'mem2' : ('.0123', '.amb', '.ann', '.bwt.2bit.64', '.pac'),
+}
+CACHE_INDEX_PROG = 'cs_cacheBwaIndex.py'
+
 ##############################################################################
 
+def unique_file_tag():
+  '''
+  Return a string making a file name unique across the processes
+  sharing a cluster directory.
+  '''
+  return '%s-%d-%d' % (PROCESS_TAG, os.getpid(), next(FILE_COUNTER))
+
 def make_bam_name_without_extension(fqname):
 
   """Creates bam file basename out of Odom/Carroll lab standard fq
@@ -59,14 +108,139 @@ def make_bam_name_without_extension(fqname):
   if fqname.endswith('.gz') or fqname.endswith('.bz2'):
     fqname = os.path.splitext(fqname)[0]
   base         = os.path.splitext(fqname)[0]
-  lane_pattern = re.compile(r'^(.*)p[12](@\d+)?$')
-  matchobj     = lane_pattern.match(base)
+  matchobj     = LANE_PATTERN.match(base)
   if matchobj != None:
     base = matchobj.group(1)
     if matchobj.group(2):
       base += matchobj.group(2)
   return base
 
+def parse_job_id(lines, clustertype):
+  '''
+  Return the integer job ID reported in the output lines of an LSF or
+  SLURM job submission. File-like output is closed once read.
+  '''
+  jobid_pattern = JOBID_PATTERNS.get(clustertype)
+  if jobid_pattern is None:
+    LOGGER.error("Unknown cluster type '%s'. Exiting.", clustertype)
+    sys.exit(1)
+
+  # The submission has already completed by the time we get here
+  # (see call_subprocess), so we only need to scan as far as the
+  # first match before releasing the captured output.
+  try:
+    for line in lines:
+      matchobj = jobid_pattern.search(line)
+      if matchobj:
+        jobid = int(matchobj.group(1))
+        LOGGER.info("ID of submitted job: %d", jobid)
+        return jobid
+  finally:
+    if hasattr(lines, 'close'):
+      lines.close()
+
+  raise ValueError("Unable to parse job scheduler output for job ID.")
+
+def parse_job_ids(lines, clustertype, count=None):
+  '''
+  Return the list of integer job IDs reported, in submission order, in
+  the output lines of several LSF or SLURM job submissions run
+  together. If count is given, exactly that many IDs must be
+  found. File-like output is closed once read.
+  '''
+  jobid_pattern = JOBID_PATTERNS.get(clustertype)
+  if jobid_pattern is None:
+    LOGGER.error("Unknown cluster type '%s'. Exiting.", clustertype)
+    sys.exit(1)
+
+  jobids = []
+  try:
+    for line in lines:
+      matchobj = jobid_pattern.search(line)
+      if matchobj:
+        jobids.append(int(matchobj.group(1)))
+        LOGGER.info("ID of submitted job: %d", jobids[-1])
+  finally:
+    if hasattr(lines, 'close'):
+      lines.close()
+
+  if count is not None and len(jobids) != count:
+    raise ValueError("Expected %d job IDs in job scheduler output; found %d."
+                     % (count, len(jobids)))
+
+  return jobids
+
+def submit_job_chain(runner, cmds, clustertype, prefix='', **kwargs):
+  '''
+  Run several job submission commands through runner in a single
+  call, returning the list of integer job IDs in submission order. The
+  chain stops at the first failed submission; any jobs already
+  submitted are then cancelled before CalledProcessError is raised, so
+  that callers never have to deal with a partial submission. The
+  prefix (e.g. "export PATH=... && ") is run ahead of both the chain
+  and any cancellation.
+  '''
+  chain = "%s(%s); echo %s$?" % (prefix, " && ".join(cmds), CHAIN_STATUS_TAG)
+  pout  = runner.run_command(chain, command_builder=SimpleCommand(), **kwargs)
+  if runner.test_mode:
+    return [ 0 ] * len(cmds)
+
+  lines = pout.readlines()
+  pout.close()
+  status = 1
+  if lines and lines[-1].startswith(CHAIN_STATUS_TAG):
+    status = int(lines.pop()[len(CHAIN_STATUS_TAG):])
+
+  if status != 0:
+    jobids = parse_job_ids(lines, clustertype)
+    if jobids:
+      LOGGER.warning("Job submission failed; cancelling the %d job(s) already submitted.",
+                     len(jobids))
+      runner.run_command("%s%s %s" % (prefix, JOB_CANCEL_COMMANDS[clustertype],
+                                      " ".join([ str(x) for x in jobids ])),
+                         command_builder=SimpleCommand(), **kwargs)
+    raise CalledProcessError(status, chain)
+
+  return parse_job_ids(lines, clustertype, len(cmds))
+
+def run_in_threads(func, arglist, max_threads=None):
+  '''
+  Call func once per item in arglist, each in its own thread, and
+  return the results in the same order. If max_threads is set, at
+  most that many threads are started and each works through the
+  remaining items in turn. Any exception raised in a thread is
+  re-raised once all threads have finished.
+  '''
+  results = [ None ] * len(arglist)
+  errors  = []
+  tasks   = enumerate(arglist)
+  lock    = threading.Lock()
+
+  def _call():
+    while True:
+      with lock:
+        task = next(tasks, None)
+      if task is None:
+        return
+      (index, arg) = task
+      try:
+        results[index] = func(arg)
+      except Exception, err:
+        errors.append(err)
+
+  nthreads = len(arglist)
+  if max_threads is not None:
+    nthreads = min(nthreads, max_threads)
+  threads = [ threading.Thread(target=_call) for _ in range(nthreads) ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  if errors:
+    raise errors[0]
+
+  return results
 
 ##############################################################################
 ##############################################################################
@@ -75,12 +249,38 @@ class SimpleCommand(object):
   '''
   Simple class used as a default command-string builder.
   '''
-  __slots__ = ('conf')
+  __slots__ = ('conf', '_base_env', '_base_envstr')
 
   def __init__(self):
 
     self.conf = Config()
 
+    # Pass the PYTHONPATH to the cluster process. This allows us to
+    # isolate e.g. a testing instance of the code from production.
+    # Note that we can't do this as easily for PATH itself because
+    # bsub itself is in a custom location on the cluster. Collected
+    # once here rather than on every build() call.
+    self._base_env = dict( (varname, os.environ[varname])
+                           for varname in ('PYTHONPATH', 'OSQPIPE_CONFDIR')
+                           if varname in os.environ )
+    self._base_envstr = self._environment_string(self._base_env)
+
+  @staticmethod
+  def _environment_string(environ):
+    return " ".join([ "%s=%s" % (key, val) for key, val in environ.iteritems() ])
+
+  def environment(self, environ=None):
+    '''
+    Return the environment variable assignments to prefix to a
+    command, given a dict of extra variables (e.g., JAVA_HOME) from
+    the caller. PYTHONPATH and OSQPIPE_CONFDIR are always passed on.
+    '''
+    if not environ:
+      return self._base_envstr
+    merged = dict(environ)
+    merged.update(self._base_env)
+    return self._environment_string(merged)
+
   def build(self, cmd, *args, **kwargs):
     
     if type(cmd) in (str, unicode):
@@ -115,26 +315,59 @@ class SbatchCommand(SimpleCommand):
   Class used to build sbatch-wrapped command.
   '''
 
+  # The fixed parts of the sbatch script, filled in for each job by
+  # build() from a single dict of values. The optional directives
+  # (jobname, GPUs, dependencies) are added around these.
+  DIRECTIVES = '\n'.join([
+    '#SBATCH -N 1', # Make sure that all cores are in one node
+    '#SBATCH --mincpus=%(mincpus)d', # Specify the number of CPU cores we need. Using --ntasks 1 and --cpus-per-task=mincpus should do the same job.
+    '#SBATCH --mail-type=NONE', # never receive mail
+    '#SBATCH -p %(queue)s', # Queue where the job is sent.
+    '#SBATCH --open-mode=append', # record information about job re-sceduling
+    '#SBATCH %(requeue)s', # requeue job in case node dies etc., or not.
+    '#SBATCH --mem %(mem)s']) # memory in MB
+
+  LIMITS = '\n'.join([
+    '#SBATCH -t %(time_limit)d:0:0', # Note that time_limit is an integer indicating hours.
+    '#SBATCH -o %(clusterlogdir)s/%%j.stdout', # File to which STDOUT will be written
+    '#SBATCH -e %(clusterlogdir)s/%%j.stderr']) # File to which STDERR will be written
+
+  SCRIPT_BODY = '\n'.join([
+    # Following (two) lines are not necessarily needed but suggested by University Darwin cluster for record keeping in scheduler log files.
+    'numnodes=$SLURM_JOB_NUM_NODES',
+    'numtasks=$SLURM_NTASKS',
+    'hostname=`hostname`',
+    'workdir=\"$SLURM_SUBMIT_DIR\"',
+    # This is the place where the actual command we want to execute is added to the script.
+    'CMD=\"%(cmd)s\"',
+    # Change dir to work directory.
+    'cd %(workdir)s',
+    'echo -e \"Changed directory to `pwd`.\n\"',
+    'JOBID=$SLURM_JOB_ID',
+    'echo -e \"JobID: $JOBID\n======\"',
+    'echo "Job start time: `date`"',
+    'echo \"Executed in node: $hostname\"',
+    'echo \"CPU info: `cat /proc/cpuinfo | grep name | uniq | tr -s \' \' | cut -f2 -d:`\"',
+    'echo \"Current directory: `pwd`\"',
+    # 'echo -e \"\nnumtasks=$numtasks, numnodes=$numnodes\"',
+    'echo -e \"Number of cores requested: min=%(mincpus)d, max=%(maxcpus)d\"',
+    'echo -e \"Number of nodes received: $numnodes\"',
+    'echo -e \"\nExecuting command:\n==================\n$CMD\n\"',
+    'mv %(slurmfile)s %(clusterlogdir)s/$SLURM_JOB_ID.sh',
+    'eval $CMD',
+    '',
+    'echo "Job end time: `date`"']) + '\n'
+
   def build(self, cmd, mem=2000, time_limit=48, queue=None, jobname=None,
             auto_requeue=False, depend_jobs=None, sleep=0,
-            mincpus=1, maxcpus=1, clusterlogdir=None, environ=None, *args, **kwargs):
+            mincpus=1, maxcpus=1, clusterlogdir=None, environ=None, gpus=0, *args, **kwargs):
+    cmd = super(SbatchCommand, self).build(cmd, *args, **kwargs)
+
     # The environ argument allows the caller to pass in arbitrary
     # environmental variables (e.g., JAVA_HOME) as a dict.
-    if environ is None:
-      environ = {}
-
-    # Pass the PYTHONPATH to the cluster process. This allows us to
-    # isolate e.g. a testing instance of the code from production.
-    # Note that we can't do this as easily for PATH itself because
-    # bsub itself is in a custom location on the cluster.
-    for varname in ('PYTHONPATH', 'OSQPIPE_CONFDIR'):
-      if varname in os.environ:
-        environ[varname] = os.environ[varname]
-
-    cmd = super(SbatchCommand, self).build(cmd, *args, **kwargs)
+    envstr = self.environment(environ)
 
     # Add information about environment in front of the command.
-    envstr = " ".join([ "%s=%s" % (key, val) for key, val in environ.iteritems() ])
     cmd = envstr + " " + cmd
 
     # In some cases it is beneficial to wait couple of seconds before the job is executed
@@ -142,81 +375,55 @@ class SbatchCommand(SimpleCommand):
     if sleep > 0:
       cmd = ('sleep %d && ' % sleep) + cmd
 
-    # uuid.uuid1() creates unique string based on hostname and time.
-    ltmpdir = tempfile.gettempdir()
-    slurmfile = str(uuid.uuid1())
+    slurmfile = '%s-%d-%d' % (SLURM_FILE_PREFIX, os.getpid(),
+                              next(FILE_COUNTER))
     # if cluster log dir has not been specified, overwrite locally with clusterstdoutdir
     if clusterlogdir is None:
       clusterlogdir = self.conf.clusterstdoutdir
+    clusterlogdir = clusterlogdir.rstrip('/')
     fslurmfile = os.path.join(clusterlogdir, slurmfile)
 
-    # Create sbatch bash script to a long string
-    cmd_text = '#!/bin/bash\n'
-    if jobname is not None:
-      cmd_text += '#SBATCH -J %s\n' % jobname # where darwinjob is the jobname
-    #cmd_text += '#SBATCH -A CHANGEME\n' # In university cluster paid version this argument is important! I.e. which project should be charged.
     # A safety net in case min or max nr of cores gets muddled up. An
     # explicit error is preferred in such cases, so that we can see
     # what to fix.
     if mincpus > maxcpus:
-      maxcpus = mincpus
-      LOGGER.info("mincpus (%d) is greater than maxcpus (%d). Maxcpus was made equal to mincpus!" % (mincpus, maxcpus))
-    cmd_text += '#SBATCH -N 1\n' # Make sure that all cores are in one node
-    cmd_text += '#SBATCH --mincpus=%d\n' % mincpus # Specify the number of CPU cores we need. Using --ntasks 1 and --cpus-per-task=mincpus should do the same job.
-    cmd_text += '#SBATCH --mail-type=NONE\n' # never receive mail
-    if queue is None:
-      cmd_text += '#SBATCH -p %s\n' % self.conf.clusterqueue # Queue where the job is sent.
-    else:
-      cmd_text += '#SBATCH -p %s\n' % queue # Queue where the job is sent.
-    cmd_text += '#SBATCH --open-mode=append\n' # record information about job re-sceduling
-    if auto_requeue:
-      cmd_text += '#SBATCH --requeue\n' # requeue job in case node dies etc.
-    else:
-      cmd_text += '#SBATCH --no-requeue\n' # do not requeue the job
-    cmd_text += '#SBATCH --mem %s\n' % mem # memory in MB
-    cmd_text += '#SBATCH -t %d:0:0\n' % time_limit # Note that time_limit is an integer indicating hours.
-    cmd_text += '#SBATCH -o %s/%%j.stdout\n' % clusterlogdir # File to which STDOUT will be written
-    cmd_text += '#SBATCH -e %s/%%j.stderr\n' % clusterlogdir # File to which STDERR will be written
+      LOGGER.info("mincpus (%d) is greater than maxcpus (%d). Maxcpus was made equal to mincpus!", mincpus, maxcpus)
+    maxcpus = max(mincpus, maxcpus)
+
+    values = {
+      'cmd'           : cmd,
+      'workdir'       : self.conf.clusterworkdir,
+      'queue'         : self.conf.clusterqueue if queue is None else queue,
+      'requeue'       : '--requeue' if auto_requeue else '--no-requeue',
+      'mem'           : mem,
+      'time_limit'    : time_limit,
+      'mincpus'       : mincpus,
+      'maxcpus'       : maxcpus,
+      'slurmfile'     : fslurmfile,
+      'clusterlogdir' : clusterlogdir }
+
+    # Create sbatch bash script as a list of blocks, joined once at the end.
+    parts = ['#!/bin/bash']
+    if jobname is not None:
+      parts.append('#SBATCH -J %s' % jobname) # where darwinjob is the jobname
+    #parts.append('#SBATCH -A CHANGEME') # In university cluster paid version this argument is important! I.e. which project should be charged.
+    parts.append(self.DIRECTIVES % values)
+    if gpus > 0:
+      parts.append('#SBATCH --gres=gpu:%d' % gpus) # GPUs per node
+    parts.append(self.LIMITS % values)
     if depend_jobs is not None:
-      dependencies = '#SBATCH --dependency=aftercorr' # execute job after all corresponding jobs
-      for djob in depend_jobs:
-        dependencies += ':%s' % djob
-      cmd_text += '%s\n' % dependencies
-    # Following (two) lines are not necessarily needed but suggested by University Darwin cluster for record keeping in scheduler log files.
-    cmd_text += 'numnodes=$SLURM_JOB_NUM_NODES\n'
-    cmd_text += 'numtasks=$SLURM_NTASKS\n'
-    cmd_text += 'hostname=`hostname`\n'
-    cmd_text += 'workdir=\"$SLURM_SUBMIT_DIR\"\n'
-    # This is the place where the actual command we want to execute is added to the script.
-    cmd_text += 'CMD=\"%s\"\n' % cmd
-    # Change dir to work directory.
-    cmd_text += 'cd %s\n' % self.conf.clusterworkdir
-    cmd_text += 'echo -e \"Changed directory to `pwd`.\n\"\n'
-    cmd_text += 'JOBID=$SLURM_JOB_ID\n'
-    cmd_text += 'echo -e \"JobID: $JOBID\n======\"\n'
-    cmd_text += 'echo "Job start time: `date`"\n'
-    cmd_text += 'echo \"Executed in node: $hostname\"\n'
-    cmd_text += 'echo \"CPU info: `cat /proc/cpuinfo | grep name | uniq | tr -s \' \' | cut -f2 -d:`\"\n'
-    cmd_text += 'echo \"Current directory: `pwd`\"\n'
-    # cmd_text += 'echo -e \"\nnumtasks=$numtasks, numnodes=$numnodes\"\n'
-    cmd_text += 'echo -e \"Number of cores requested: min=%d, max=%d\"\n' % (mincpus, maxcpus)
-    cmd_text += 'echo -e \"Number of nodes received: $numnodes\"\n'
-    cmd_text += 'echo -e \"\nExecuting command:\n==================\n$CMD\n\"\n'
-    cmd_text += 'mv %s %s/$SLURM_JOB_ID.sh\n' % (fslurmfile, clusterlogdir)
-    cmd_text += 'eval $CMD\n\n'
-    cmd_text += 'echo "Job end time: `date`"\n'
-    # Write sbatch file to cluster
+      # execute job after all corresponding jobs
+      parts.append(':'.join(['#SBATCH --dependency=aftercorr'] + [ str(djob) for djob in depend_jobs ]))
+    cmd_text = '\n'.join(parts) + '\n' + self.SCRIPT_BODY % values
+
+    # Create slurm command. Rather than writing the script to the
+    # cluster in a separate ssh session, it is carried in the command
+    # itself (base64-encoded, so it survives any level of shell
+    # quoting) and piped to sbatch, keeping a copy in fslurmfile. The
+    # sh -c wrapper lets a PATH set by the caller apply to sbatch.
+    slurmcmd = ("sh -c 'echo %s | base64 -d | tee %s | sbatch'"
+                % (base64.b64encode(cmd_text), fslurmfile))
 
-    try:
-      sshkey = self.conf.clustersshkey
-    except AttributeError, _err:
-      sshkey = None
-    write_to_remote_file(cmd_text, fslurmfile, self.conf.clusteruser,
-                         self.conf.cluster, append=False, sshkey=sshkey)
-
-    # Create slurm command
-    slurmcmd = 'sbatch %s' % fslurmfile
-    
     return slurmcmd
 
 class BsubCommand(SimpleCommand):
@@ -225,22 +432,14 @@ class BsubCommand(SimpleCommand):
   '''
   def build(self, cmd, mem=2000, time_limit=None, queue=None, jobname=None,
             auto_requeue=False, depend_jobs=None, sleep=0, 
-            mincpus=1, maxcpus=1, clusterlogdir=None, environ=None, *args, **kwargs):
+            mincpus=1, maxcpus=1, clusterlogdir=None, environ=None, gpus=0,
+            array=None, *args, **kwargs):
+
+    cmd = super(BsubCommand, self).build(cmd, *args, **kwargs)
 
     # The environ argument allows the caller to pass in arbitrary
     # environmental variables (e.g., JAVA_HOME) as a dict.
-    if environ is None:
-      environ = {}
-
-    # Pass the PYTHONPATH to the cluster process. This allows us to
-    # isolate e.g. a testing instance of the code from production.
-    # Note that we can't do this as easily for PATH itself because
-    # bsub itself is in a custom location on the cluster.
-    for varname in ('PYTHONPATH', 'OSQPIPE_CONFDIR'):
-      if varname in os.environ:
-        environ[varname] = os.environ[varname]
-
-    cmd = super(BsubCommand, self).build(cmd, *args, **kwargs)
+    envstr = self.environment(environ)
 
     # Note that if this gets stuck in an infinite loop you will need
     # to use "bkill -r" to kill the job on LSF. N.B. exit code 139 is
@@ -272,43 +471,48 @@ class BsubCommand(SimpleCommand):
     # explicit error is preferred in such cases, so that we can see
     # what to fix.
     if mincpus > maxcpus:
-      maxcpus = mincpus
-      LOGGER.info("mincpus (%d) is greater than maxcpus (%d). Maxcpus was made equal to mincpus!" % (mincpus, maxcpus))
+      LOGGER.info("mincpus (%d) is greater than maxcpus (%d). Maxcpus was made equal to mincpus!", mincpus, maxcpus)
+    maxcpus = max(mincpus, maxcpus)
 
     # In case clusterlogdir has been specified, override the self.conf.clusterstdout
     # This is handy in case we want to keep the logs together with job / larger project related files.
-    cluster_stdout_stderr = ""
-    if clusterlogdir is not None:
-      cluster_stdout_stderr = "-o %s/%%J.stdout -e %s/%%J.stderr" % (clusterlogdir, clusterlogdir)
-    else:
-      cluster_stdout_stderr = "-o %s/%%J.stdout -e %s/%%J.stderr" % (self.conf.clusterstdoutdir, self.conf.clusterstdoutdir)
-
-    envstr  = " ".join([ "%s=%s" % (key, val) for key, val in environ.iteritems() ])
-    bsubcmd = (("%s bsub -R '%s' -R 'span[hosts=1]'"
-           + " %s -r %s -n %d,%d"
-                + " %s %s")
-           % (envstr,
-              resources,
-              memreq,
-              cluster_stdout_stderr,
-              mincpus,
-              maxcpus,
-              qval,
-              group))
+    # Elements of a job array share a job ID, so their logs are kept
+    # apart by array index.
+    if clusterlogdir is None:
+      clusterlogdir = self.conf.clusterstdoutdir
+    cluster_stdout_stderr = ("-o %(logdir)s/%(logname)s.stdout -e %(logdir)s/%(logname)s.stderr"
+                             % {'logdir'  : clusterlogdir.rstrip('/'),
+                                'logname' : '%J' if array is None else '%J_%I'})
+
+    parts  = [ envstr, 'bsub',
+               "-R '%s'" % resources,
+               "-R 'span[hosts=1]'",
+               memreq,
+               '-r',
+               cluster_stdout_stderr,
+               '-n %d,%d' % (mincpus, maxcpus),
+               qval,
+               group ]
 
     if queue is not None:
-      bsubcmd += ' -q %s' % queue
+      parts.append('-q %s' % queue)
+
+    if gpus > 0:
+      parts.append("-gpu 'num=%d'" % gpus)
 
-    # The jobname attribute is also used to control LSF job array creation.
+    # The jobname attribute is also used to control LSF job array
+    # creation; the array argument gives the number of elements.
     if jobname is not None:
-      bsubcmd += ' -J %s' % jobname
+      if array is not None:
+        jobname = '%s[1-%d]' % (jobname, array)
+      parts.append('-J %s' % quote(jobname))
 
     if depend_jobs is not None:
       depend = "&&".join([ "ended(%d)" % (x,) for x in depend_jobs ])
-      bsubcmd += " -w '%s'" % depend
+      parts.append("-w '%s'" % depend)
 
     if time_limit is not None:
-      bsubcmd += " -W %d:00" % time_limit
+      parts.append("-W %d:00" % time_limit)
 
     if sleep > 0:
       cmd = ('sleep %d && ' % sleep) + cmd
@@ -322,9 +526,9 @@ class BsubCommand(SimpleCommand):
     #
     # I.e., one needs to be careful of python's rather idiosyncratic
     # string quoting rules, and use the r"" form where necessary.
-    bsubcmd += r' sh -c "(%s)"' % re.sub(r'"', r'\"', cmd)
+    parts.append(r'sh -c "(%s)"' % cmd.replace('"', r'\"'))
 
-    return bsubcmd
+    return " ".join(parts)
 
 ##############################################################################
 class JobRunner(object):
@@ -389,6 +593,20 @@ class JobRunner(object):
     '''
     return self.run_command(*args, **kwargs)
 
+  def close(self):
+    '''
+    Release any resources held by this runner. Local runners hold
+    none; subclasses override this as needed.
+    '''
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
+
 class JobSubmitter(JobRunner):
 
   '''Class to run jobs via LSF/bsub on the local host (i.e., when running on the cluster).'''
@@ -417,24 +635,24 @@ class JobSubmitter(JobRunner):
            submit_command(cmd,
                           *args, **kwargs)
 
-    # FIXME this could be farmed out to utilities?
-    jobid_pattern = None
-    if self.config.clustertype == 'LSF':
-      jobid_pattern = re.compile(r"Job\s+<(\d+)>\s+is\s+submitted\s+to")
-    elif self.config.clustertype == 'SLURM':
-      jobid_pattern = re.compile(r"Submitted batch job (\d+)")
+    if not self.test_mode:
+      return parse_job_id(pout, self.config.clustertype)
     else:
-      LOGGER.error("Unknown cluster type '%s'. Exiting.", self.config.clustertype)
-      sys.exit(1)
-
-    for line in pout:
-      matchobj = jobid_pattern.search(line)
-      if matchobj:
-        jobid = int(matchobj.group(1))
-        LOGGER.info("ID of submitted job: %d", jobid)
-        return jobid
+      return 0 # Test mode only.
 
-    raise ValueError("Unable to parse job scheduler output for job ID.")
+  def submit_many(self, jobs, path=None, tmpdir=None):
+    '''
+    Submit several independent jobs in a single remote command, saving
+    one ssh round trip per job. The jobs argument is a list of (cmd,
+    kwargs) pairs, where kwargs are the extra arguments passed to the
+    command builder's build() method. Returns the list of integer job
+    IDs in the same order as jobs; if any submission fails, those
+    already made are cancelled (see submit_job_chain).
+    '''
+    cmds = [ self.command_builder.build(cmd, **kwargs)
+             for (cmd, kwargs) in jobs ]
+    return submit_job_chain(self, cmds, self.config.clustertype,
+                            path=path, tmpdir=tmpdir)
 
 class RemoteJobRunner(JobRunner):
   '''
@@ -458,6 +676,9 @@ class RemoteJobRunner(JobRunner):
       raise StandardError("Remote host information not provided.")
     super(RemoteJobRunner, self).__init__(*args, **kwargs)
 
+    # Results of find_remote_executable, keyed by (progname, path).
+    self._exec_cache = {}
+
   def run_command(self, cmd, wdir=None, path=None, command_builder=None, *args, **kwargs):
     '''
     Method used to run a command *directly* on the remote host. No
@@ -466,7 +687,9 @@ class RemoteJobRunner(JobRunner):
 
     The command call is wrapped in an ssh connection. This command will
     also automatically change to the configured remote working
-    directory before executing the command.
+    directory before executing the command. The command is parsed by
+    the remote shell only, so filenames need quoting (bash_quote or
+    quote) just once, for that shell.
     '''
     if command_builder:
       cmd = command_builder.build(cmd, *args, **kwargs)
@@ -483,53 +706,70 @@ class RemoteJobRunner(JobRunner):
         path = ":".join(path)
       pathdef = "PATH=%s" % path
 
-    # Allow for custom ssh key specification in our config.
-    sshcmd = "ssh"
+    # Allow for custom ssh key specification in our config. The
+    # connection is shared with later ssh/scp calls to the same host.
+    sshcmd = ['ssh'] + SSH_MUX_OPTS.split()
     try:
       sshkey = self.conf.clustersshkey
-      sshcmd += ' -i %s' % sshkey
+      sshcmd += ['-i', sshkey]
     except AttributeError, _err:
       pass
 
-    cmd = ("%s -p %s %s@%s \"source /etc/profile; cd %s && %s %s\""
-           % (sshcmd,
-              str(self.remote_port),
-              self.remote_user,
-              self.remote_host,
-              wdir,
-              pathdef,
-              re.sub(r'"', r'\"', cmd)))
-    LOGGER.debug(cmd)
+    # The remote command is passed as a single argument, so only the
+    # remote shell parses it and no local quoting is needed.
+    sshcmd += ['-p', str(self.remote_port),
+               "%s@%s" % (self.remote_user, self.remote_host),
+               "source /etc/profile; cd %s && %s %s" % (wdir, pathdef, cmd)]
+    LOGGER.debug(" ".join(sshcmd))
     if not self.test_mode:
-      return call_subprocess(cmd, shell=True, path=self.config.hostpath)
+      return call_subprocess(sshcmd, path=self.config.hostpath)
     return None
 
+  def close(self):
+    '''
+    Shut down the shared ssh master connections (see SSH_MUX_OPTS)
+    to the remote and transfer hosts, rather than leaving them to
+    time out.
+    '''
+    if self.test_mode:
+      return
+    for host in sorted(set([self.remote_host, self.transfer_host])):
+      sshcmd = (['ssh'] + SSH_MUX_OPTS.split()
+                + ['-p', str(self.remote_port), '-O', 'exit',
+                   "%s@%s" % (self.remote_user, host)])
+      # The exit status is ignored; ssh fails harmlessly when no
+      # master connection is open.
+      kid = Popen(sshcmd, stdout=PIPE, stderr=PIPE,
+                  env=dict(os.environ, PATH=self.config.hostpath))
+      kid.communicate()
+
   def find_remote_executable(self, progname, path=None):
     '''
-    Quick (and a little dirty) approach to identifying an executable
-    file on the specified path on a remote server (defaults to the
-    default shell $PATH var).
+    Identify an executable file on the specified path on a remote
+    server (defaults to the default shell $PATH var). Results are
+    cached, so repeated lookups do not need another ssh call.
     '''
-    # This is a fairly simple shell script which just iterates over
-    # the elements in $PATH and returns the first hit for an
-    # executable file of the specified progname.
-    cmd = (r"""IFS=':' read -a myary <<< \$PATH && for elem in \${myary[@]};"""
-           + (r""" do if [ -x \${elem}/%s ]; then found=\${elem}/%s; break; fi; done && echo \$found"""
-              % (progname, progname)))
+    key = (progname, ":".join(path) if type(path) is list else path)
+    if key in self._exec_cache:
+      return self._exec_cache[key]
+
+    # The POSIX "command -v" builtin prints the full path of the first
+    # match in $PATH; a bare name would mean a shell builtin or
+    # function rather than an executable file. The "|| true" stops a
+    # failed lookup being treated as an ssh error.
+    cmd = "command -v %s || true" % quote(progname)
 
     # Run the command directly on the server (without bsub or nohup).
     output = self.run_command(cmd, path=path, command_builder=SimpleCommand())
 
     # One or zero lines should be returned.
-    line = output.next()
-    if line is None:
-      return None
-
-    executable = line.strip()
-    if executable == '':
-      return None
+    executable = output.readline().strip()
+    if not executable.startswith('/'):
+      executable = None
+    else:
+      LOGGER.debug('Found remote executable at %s', executable)
 
-    LOGGER.debug('Found remote executable at %s', executable)
+    self._exec_cache[key] = executable
     return executable
 
   def remote_copy_files(self, filenames, destnames=None, same_permissions=False):
@@ -541,35 +781,53 @@ class RemoteJobRunner(JobRunner):
     if len(filenames) != len(destnames):
       raise ValueError("If used, the length of the destnames list"
                                                                           + " must equal that of the filenames list.")
-    for i in range(0, len(filenames)):
-      fromfn = filenames[i]
-      destfn = destnames[i]
-      
-      destfile = os.path.join(self.transfer_wdir, destfn)
-      destfile = bash_quote(destfile)
-      
-      # Currently we assume that the same login credentials work for
-      # both the cluster and the data transfer host. Note that this
-      # needs an appropriate ssh key to be authorised on both the
-      # transfer host and the cluster host.
-      cmdbits = ['scp', '-P', str(self.remote_port)]
-      if same_permissions: # default is to use the configured umask.
-        cmdbits += ['-p']
-      try:
-        sshkey = self.conf.clustersshkey
-        cmdbits += ['-i', sshkey]
-      except AttributeError, _err:
-        pass
 
-      cmdbits += ['-q', bash_quote(fromfn),
-                  "%s@%s:%s" % (self.remote_user,
+    # Currently we assume that the same login credentials work for
+    # both the cluster and the data transfer host. Note that this
+    # needs an appropriate ssh key to be authorised on both the
+    # transfer host and the cluster host.
+    scpbits = ['scp', '-P', str(self.remote_port)] + SSH_MUX_OPTS.split()
+    if same_permissions: # default is to use the configured umask.
+      scpbits += ['-p']
+    try:
+      sshkey = self.conf.clustersshkey
+      scpbits += ['-i', sshkey]
+    except AttributeError, _err:
+      pass
+    scpbits += ['-q']
+
+    # Files keeping their own name are sent together in a single scp
+    # session per destination directory; renamed files need one each.
+    batches = {}
+    renamed = []
+    for fromfn, destfn in zip(filenames, destnames):
+      if os.path.basename(destfn) == os.path.basename(fromfn):
+        destdir = os.path.join(self.transfer_wdir, os.path.dirname(destfn))
+        batches.setdefault(destdir, []).append(fromfn)
+      else:
+        renamed.append((fromfn, destfn))
+
+    transfers = [ (fromfns, destdir) for destdir, fromfns in sorted(batches.items()) ]
+    for fromfn, destfn in renamed:
+      transfers.append(([fromfn], os.path.join(self.transfer_wdir, destfn)))
+
+    def _transfer(transfer):
+      (fromfns, dest) = transfer
+
+      # No local shell is involved; only the remote side of scp
+      # needs the destination path quoted.
+      cmdbits = scpbits + fromfns
+      cmdbits += ["%s@%s:%s" % (self.remote_user,
                                 self.transfer_host,
-                                quote(destfile))]
-      cmd = " ".join(cmdbits)
+                                bash_quote(dest))]
 
-      LOGGER.info(cmd)
+      LOGGER.info(" ".join(cmdbits))
       if not self.test_mode:
-        call_subprocess(cmd, shell=True, path=self.conf.hostpath)
+        call_subprocess(cmdbits, path=self.conf.hostpath)
+
+    # The scp sessions are independent and network-bound, so a few
+    # are kept running concurrently.
+    run_in_threads(_transfer, transfers, max_threads=MAX_SCP_THREADS)
 
   def remote_uncompress_file(self, fname, zipcommand='gzip'):
     '''
@@ -690,26 +948,27 @@ class ClusterJobSubmitter(RemoteJobRunner):
         submit_command(cmd,
                        path=self.conf.clusterpath,
                        *args, **kwargs)
-    jobid_pattern = None
-    if self.conf.clustertype == 'LSF':
-      jobid_pattern = re.compile(r"Job\s+<(\d+)>\s+is\s+submitted\s+to")
-    elif self.conf.clustertype == 'SLURM':
-      jobid_pattern = re.compile(r"Submitted batch job (\d+)")
-    else:
-      LOGGER.error("Unknown cluster type '%s'. Exiting.", self.conf.clustertype)
-      sys.exit(1)
-    
     if not self.test_mode:
-      for line in pout:
-        matchobj = jobid_pattern.search(line)
-        if matchobj:
-          jobid = int(matchobj.group(1))
-          LOGGER.info("ID of submitted job: %d", jobid)
-          return jobid
-
-      raise ValueError("Unable to parse bsub output for job ID.")
+      return parse_job_id(pout, self.conf.clustertype)
     else:
       return 0 # Test mode only.
+
+  def submit_many(self, jobs, **kwargs):
+    '''
+    Submit several independent jobs to the cluster in a single ssh
+    session. The jobs argument is a list of (cmd, kwargs) pairs as for
+    JobSubmitter.submit_many(). Returns the list of integer job IDs in
+    the same order as jobs; if any submission fails, those already
+    made are cancelled (see submit_job_chain).
+    '''
+    cmds = [ self.command_builder.build(cmd, **jobargs)
+             for (cmd, jobargs) in jobs ]
+
+    # A PATH=... prefix would only apply to the first submission in
+    # the chain, so export it for the whole remote command instead.
+    return submit_job_chain(self, cmds, self.conf.clustertype,
+                            prefix="export PATH=%s && " % (self.conf.clusterpath,),
+                            **kwargs)
     
 class ClusterJobRunner(RemoteJobRunner):
   
@@ -781,7 +1040,8 @@ class AlignmentManager(object):
   (and merging their output) on the cluster.
   '''
   __slots__ = ('conf', 'samtools_prog', 'group', 'cleanup', 'loglevel',
-               'split_read_count', 'bsub', 'merge_prog', 'logfile', 'debug', 'threads', 'sortthreads','postprocess')
+               'split_read_count', 'bsub', 'merge_prog', 'logfile', 'debug', 'threads', 'sortthreads','postprocess',
+               '_log_handler')
 
   def __init__(self, merge_prog=None, cleanup=False, group=None,
                split_read_count=1000000,
@@ -802,6 +1062,7 @@ class AlignmentManager(object):
     self.cleanup       = cleanup
     self.group         = group
     self.debug         = debug    
+    self._log_handler  = None
 
     if self.merge_prog is None:
       self.merge_prog = 'cs_runBwaWithSplit_Merge.py'
@@ -825,41 +1086,117 @@ class AlignmentManager(object):
     fmt = logging.Formatter(logfmt)
     
     # Push stderr to logs; Note that any required StreamHandlers will
-    # have been added in the child class.
+    # have been added in the child class. Repeated instantiation
+    # reuses a handler already writing to our log file, so that each
+    # record is only written once.
+    logpath = os.path.abspath(self.logfile)
+    for hdlr in logger.handlers:
+      if isinstance(hdlr, logging.FileHandler) and hdlr.baseFilename == logpath:
+        return
+
     hdlr = logging.FileHandler(self.logfile)
     hdlr.setFormatter(fmt)
     hdlr.setLevel(min(logger.getEffectiveLevel(), logging.WARN))
     logger.addHandler(hdlr)
+    self._log_handler = hdlr
+
+  def close(self):
+    '''
+    Remove and close the log file handler added by this instance, and
+    release the job submitter's resources.
+    '''
+    if self._log_handler is not None:
+      LOGGER.removeHandler(self._log_handler)
+      self._log_handler.close()
+      self._log_handler = None
+    self.bsub.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
         
-  def split_fq(self, fastq_fn):
+  def split_fq(self, fastq_fn, host=None):
     '''
     Splits fastq file to self.split_read_count reads per file using
     linux command line split for speed.
     In case compressed (gzip or bzip), the file will be uncompressed on fly.    
+    If host is given, fastq_fn is a path on that host and the file is
+    streamed over ssh straight into split, without a local copy.
+    If the optional compresssplits config option is set to True, the
+    split files are written gzipped (all our aligners read gzipped
+    fastq), which cuts the scratch disk I/O of both splitting and
+    alignment at some cost in CPU.
     '''
     LOGGER.info("Splitting %s (%d reads per split)", fastq_fn, (self.split_read_count*self.threads) )
 
-    fastq_fn_suffix = fastq_fn + '-'
-    if fastq_fn.endswith('.gz'):
-      fastq_fn_suffix = fastq_fn.rstrip('.gz') + '-'
-      cmd = 'gunzip -c %s | split -l %d - %s' % ( quote(fastq_fn), (self.split_read_count*4*self.threads), quote(fastq_fn_suffix) )
-    elif fastq_fn.endswith('.bz2'):
-      fastq_fn_suffix = fastq_fn.rstrip('.bz2') + '-'
-      cmd = 'bzcat %s | split -l %d - %s' % ( quote(fastq_fn), (self.split_read_count*4*self.threads), quote(fastq_fn_suffix) )
+    # Multithreaded pigz is noticeably faster where available.
+    have_pigz = which('pigz', self.conf.clusterpath)
+
+    split_cmd = "split -l %d" % (self.split_read_count*4*self.threads,)
+    chunk_ext = ''
+    try:
+      compress_splits = str(self.conf.compresssplits).lower() == 'true'
+    except AttributeError, _err:
+      compress_splits = False
+    if compress_splits:
+      # Fastest compression level, to keep up with the split itself.
+      zipper     = 'pigz -1' if have_pigz else 'gzip -1'
+      split_cmd += " --filter=%s" % quote('%s > $FILE.gz' % zipper)
+      chunk_ext  = '.gz'
+
+    if host is None:
+      local_fn = fastq_fn
+      fetch    = None
+    else:
+      # The remote path is interpreted by both local and remote shells.
+      local_fn = os.path.basename(fastq_fn)
+      fetch    = ("%s %s@%s cat %s"
+                  % (RSYNC_SSH, self.conf.clusteruser, host, quote(bash_quote(fastq_fn))))
+
+    fastq_fn_suffix = local_fn + '-'
+    if local_fn.endswith('.gz'):
+      fastq_fn_suffix = local_fn.rstrip('.gz') + '-'
+      unzip = 'pigz -dc' if have_pigz else 'gunzip -c'
+      reader = '%s | %s' % (fetch, unzip) if fetch else '%s %s' % (unzip, quote(fastq_fn))
+    elif local_fn.endswith('.bz2'):
+      fastq_fn_suffix = local_fn.rstrip('.bz2') + '-'
+      reader = '%s | bzcat' % (fetch,) if fetch else 'bzcat %s' % (quote(fastq_fn),)
+    else:
+      reader = fetch
+    if reader is not None:
+      cmd = '%s | %s - %s' % ( reader, split_cmd, quote(fastq_fn_suffix) )
     else:
-      cmd = ("split -l %d %s %s" # split -l size file.fq prefix
-             % (self.split_read_count*4*self.threads, quote(fastq_fn), quote(fastq_fn_suffix)))
-    call_subprocess(cmd, shell=True,
-                    tmpdir=self.conf.clusterworkdir,
-                    path=self.conf.clusterpath)
-
-    # glob will try and expand [, ], ? and *; we don't actually want
-    # that.  Here we quote them as per the glob docs in a character
-    # class []. We then run a second search to be sure we're getting all
-    # the files (large files split into *-zaaa and so on).
-    bash_re  = re.compile(r'([?\[\]*])')
-    fq_files =  glob.glob(bash_re.sub(r'[\1]', fastq_fn_suffix) + "??")
-    fq_files += glob.glob(bash_re.sub(r'[\1]', fastq_fn_suffix) + "????")
+      cmd = ("%s %s %s" # split -l size file.fq prefix
+             % (split_cmd, quote(fastq_fn), quote(fastq_fn_suffix)))
+
+    if host is None:
+      call_subprocess(cmd, shell=True,
+                      tmpdir=self.conf.clusterworkdir,
+                      path=self.conf.clusterpath)
+    else:
+      # The pipeline must fail if the transfer does, not just split.
+      with transfer_slot():
+        call_subprocess('set -o pipefail; %s' % (cmd,), shell=True,
+                        executable='/bin/bash',
+                        tmpdir=self.conf.clusterworkdir,
+                        path=self.conf.clusterpath)
+
+    # Collect the split outputs in a single directory listing. split
+    # names them with lowercase alphabetic suffixes, which lengthen
+    # two letters at a time for large files (*-yz, *-zaaa and so on).
+    # Plain string matching also avoids glob's special characters.
+    (split_dir, split_base) = os.path.split(fastq_fn_suffix)
+    fq_files = []
+    for fname in os.listdir(split_dir or os.curdir):
+      if not (fname.startswith(split_base) and fname.endswith(chunk_ext)):
+        continue
+      suffix = fname[len(split_base):len(fname) - len(chunk_ext)]
+      if (len(suffix) >= 2 and len(suffix) % 2 == 0
+          and suffix.isalpha() and suffix.islower()):
+        fq_files.append(os.path.join(split_dir, fname))
     fq_files.sort()
     for fname in fq_files:
       LOGGER.debug("Created fastq file: '%s'", fname)
@@ -867,11 +1204,20 @@ class AlignmentManager(object):
         set_file_permissions(self.group, fname)
 
     # Clean up 
-    if self.cleanup:
+    if self.cleanup and host is None:
       os.unlink(fastq_fn)
       LOGGER.info("Unlinking fq file '%s'", fastq_fn)
+      if os.path.exists(fastq_fn + '.done'):
+        os.unlink(fastq_fn + '.done')
     return fq_files
 
+  def split_fqs(self, fastq_fns, host=None):
+    '''
+    Split several fastq files (typically a read pair) concurrently,
+    returning a list of split file lists in the same order.
+    '''
+    return run_in_threads(lambda fn: self.split_fq(fn, host), fastq_fns)
+
   def queue_merge(self, bam_files, depend, bam_fn, rcp_target, samplename=None):
     '''
     Submits samtools job for merging list of bam files to LSF cluster.
@@ -909,18 +1255,82 @@ class AlignmentManager(object):
 
     LOGGER.debug("got job id '%s'", jobid)
 
-  def _submit_lsfjob(self, command, jobname, depend=None, sleep=0, mem=12000, threads=1):
+  def _submit_lsfjob(self, command, jobname, depend=None, sleep=0, mem=12000, threads=1,
+                     queue=None, gpus=0):
     '''
     Executes command in LSF cluster.
     '''
+    if queue is None:
+      queue = self.conf.clusterqueue
     jobid = self.bsub.submit_command(command, jobname=jobname,
                                      depend_jobs=depend, mem=mem,
                                      path=self.conf.clusterpath,
                                      tmpdir=self.conf.clusterworkdir,
-                                     queue=self.conf.clusterqueue,
+                                     queue=queue, gpus=gpus,
                                      sleep=sleep, mincpus=threads)
     return '' if jobid is None else jobid
 
+  def _submit_lsfjobs(self, jobs, sleep=0, mem=12000, threads=1, queue=None):
+    '''
+    Submits several independent (command, jobname) jobs to the LSF
+    cluster together, returning their job IDs in order.
+    '''
+    if queue is None:
+      queue = self.conf.clusterqueue
+    jobs = [ (command, dict(jobname=jobname, mem=mem, queue=queue,
+                            sleep=sleep, mincpus=threads))
+             for (command, jobname) in jobs ]
+    return self.bsub.submit_many(jobs, path=self.conf.clusterpath,
+                                 tmpdir=self.conf.clusterworkdir)
+
+  def _submit_lsfarray(self, commands, jobname, mem=12000, threads=1, queue=None):
+    '''
+    Submits a list of independent commands to the cluster in a single
+    submission, returning the list of job IDs to depend upon. On LSF
+    this is one job array with an element per command: the commands
+    are written, base64-encoded, one per line to a file in the cluster
+    working directory, and each element runs the line matching its
+    array index. A small dependent job removes that file once the
+    array has ended. Other cluster types get one job per command,
+    submitted together.
+    '''
+    if len(commands) == 1:
+      return [ self._submit_lsfjob(commands[0], jobname, mem=mem,
+                                   threads=threads, queue=queue) ]
+
+    if self.conf.clustertype != 'LSF':
+      jobs = [ (command, "%s_%d" % (jobname, num))
+               for (num, command) in enumerate(commands) ]
+      return self._submit_lsfjobs(jobs, mem=mem, threads=threads, queue=queue)
+
+    cmdfile = os.path.join(self.conf.clusterworkdir,
+                           "%s.%s.array" % (jobname, unique_file_tag()))
+    ret = write_to_remote_file("".join([ base64.b64encode(command) + "\n"
+                                         for command in commands ]),
+                               cmdfile, self.conf.clusteruser, self.conf.cluster)
+    if ret > 0:
+      LOGGER.error("Failed to create %s:%s" % (self.conf.cluster, cmdfile))
+      sys.exit(1)
+
+    # The escaped $ defers expansion of the array index until the
+    # element runs on its node.
+    cmd = "sed -n \\${LSB_JOBINDEX}p %s | base64 -d | sh" % bash_quote(cmdfile)
+
+    if queue is None:
+      queue = self.conf.clusterqueue
+    jobid = self.bsub.submit_command(cmd, jobname=jobname, array=len(commands),
+                                     mem=mem, path=self.conf.clusterpath,
+                                     tmpdir=self.conf.clusterworkdir,
+                                     queue=queue, mincpus=threads)
+    if jobid is None:
+      return [ '' ]
+
+    # Queued elements read the command file, so it can only go once
+    # the whole array has ended (successfully or not).
+    self._submit_lsfjob("rm -f %s" % bash_quote(cmdfile), "%s_cleanup" % jobname,
+                        depend=[ jobid ], mem=500, queue=queue)
+    return [ jobid ]
+
   def split_and_align(self, *args, **kwargs):
     '''
     Method used to launch the initial file splitting and bwa
@@ -974,8 +1384,11 @@ class AlignmentManager(object):
 
       # Samplename was not provided. Just rename the file
       else:
+        # This is a python-level move, so the name must not be shell
+        # quoted. shutil.move is a plain rename unless the two paths
+        # are on different filesystems.
         LOGGER.warn("Moving file: %s to %s", input_fns[0], output_fn)
-        move(input_fns[0], bash_quote(output_fn))
+        move(input_fns[0], output_fn)
 
     # More than one input files, hence need to merge and set the read group
     else:
@@ -984,8 +1397,9 @@ class AlignmentManager(object):
       m2 = "%s_m2" % bash_quote(output_fn)
       cmd = "mknod %s p && mknod %s p" % (m1, m2)
       # NB! samtools merge does not like naped pipe as output file. Hence the extra step of writing to stdout and cating to named pipe.
-      ncmd = ("%s merge -u - %s > %s\n" # assumes sorted input bams.
-              % (self.samtools_prog, " ".join([ bash_quote(x) for x in input_fns]), m1))
+      # The merge job is submitted with self.threads cores; let samtools use them for BGZF input decoding.
+      ncmd = ("%s merge -@ %d -u - %s > %s\n" # assumes sorted input bams.
+              % (self.samtools_prog, self.threads, " ".join([ bash_quote(x) for x in input_fns]), m1))
       # Prepare read group information
       (libcode, facility, lanenum, _pipeline) = parse_repository_filename(output_fn)
       if libcode is None:
@@ -996,7 +1410,7 @@ class AlignmentManager(object):
       if samplename is not None:
         sample = samplename
       else:
-        samplename = libcode
+        sample = libcode
       # Command for adding read groups
       ncmd += "picard AddOrReplaceReadGroups VALIDATION_STRINGENCY=SILENT COMPRESSION_LEVEL=0 INPUT=%s OUTPUT=%s RGLB=%s RGSM=%s RGCN=%s RGPU=%d RGPL=illumina\n" % (m1, m2, libcode, sample, facility, int(lanenum))
       # Command for compressing the file
@@ -1030,17 +1444,21 @@ class AlignmentManager(object):
             LOGGER.info("Unlinking bam file '%s'", fname)
             os.unlink(fname)
 
-  def copy_result(self, fname, destination):
+  def copy_result(self, fnames, destination):
     '''
-    Copies file to destination.
+    Copies a file, or a list of files, to destination. Several files
+    are sent in a single rsync session and marked as done with a
+    single ssh call, over one shared connection.
     '''
-    qname = bash_quote(fname)
-    # Scp is not efficient, replacing with rsync on low encryption
-    # cmd = "scp -p -q %s %s" % (qname, destination)
-    cmd = "rsync -a -e \"ssh -o StrictHostKeyChecking=no -c aes128-cbc\" %s %s" % (qname, destination)
-    print cmd
-    LOGGER.debug(cmd)
-    pout = call_subprocess(cmd, shell=True,
+    if isinstance(fnames, basestring):
+      fnames = [ fnames ]
+
+    # Scp is not efficient, replacing with rsync on low encryption.
+    # Commands are passed as argument lists so that no intermediate
+    # shell is needed (and local file names need no quoting).
+    cmd = ['rsync', '-a', '-e', RSYNC_SSH] + fnames + [destination]
+    LOGGER.debug(" ".join(cmd))
+    pout = call_subprocess(cmd,
                            tmpdir=self.conf.clusterworkdir,
                            path=self.conf.clusterpath)
     count = 0
@@ -1052,14 +1470,17 @@ class AlignmentManager(object):
       sys.exit("No files transferred.")
     flds = destination.split(":")
     if len(flds) == 2: # there's a machine and path
-      fn_base = os.path.basename(qname)
-      cmd = "ssh -o StrictHostKeyChecking=no %s touch %s/%s.done" % (flds[0], flds[1], bash_quote(fn_base))
-      LOGGER.debug(cmd)
-      call_subprocess(cmd, shell=True,
+      donefiles = [ "%s/%s.done" % (flds[1], bash_quote(os.path.basename(fname)))
+                    for fname in fnames ]
+      cmd = (['ssh', '-o', 'StrictHostKeyChecking=no'] + SSH_MUX_OPTS.split()
+             + [flds[0], "touch %s" % " ".join(donefiles)])
+      LOGGER.debug(" ".join(cmd))
+      call_subprocess(cmd,
                       tmpdir=self.conf.clusterworkdir,
                       path=self.conf.clusterpath)
     if self.cleanup:
-      os.unlink(fname)
+      for fname in fnames:
+        os.unlink(fname)
     return
 
   def picard_cleanup(self, output_fn, input_fn, samplename=None):
@@ -1147,13 +1568,24 @@ class BwaAlignmentManager(AlignmentManager):
 
     if bwa_algorithm is None:
       bwa_algorithm = 'aln'
-    assert(bwa_algorithm in ('aln', 'mem'))
+    assert(bwa_algorithm in ('aln', 'mem', 'mem2', 'mem-gpu'))
  
     super(BwaAlignmentManager, self).__init__(*args, **kwargs)
 
+    # The GPU implementation (Parabricks pbrun fq2bam) aligns the
+    # whole input in one job, so there is nothing to split. Where
+    # pbrun cannot be found we fall back to unsplit bwa-mem2.
+    if bwa_algorithm == 'mem-gpu':
+      nosplit = True
+      if which('pbrun', self.conf.clusterpath) is None:
+        LOGGER.warning("pbrun not found on clusterpath; falling back to bwa-mem2.")
+        bwa_algorithm = 'mem2'
+
     # These are now identified by passing in self.conf.clusterpath to
-    # the remote command.
-    self.bwa_prog      = 'bwa'
+    # the remote command. The mem2 algorithm uses the bwa-mem2
+    # drop-in replacement for bwa mem, which requires its own index
+    # files alongside the genome fasta.
+    self.bwa_prog      = {'mem2' : 'bwa-mem2', 'mem-gpu' : 'pbrun'}.get(bwa_algorithm, 'bwa')
     self.bwa_algorithm = bwa_algorithm
 
     self.split = True # By default, files are split for alignment with aligned files merged in the end.
@@ -1161,7 +1593,7 @@ class BwaAlignmentManager(AlignmentManager):
       self.split = False
       
     if nocc:
-      if self.bwa_algorithm == 'mem':
+      if self.bwa_algorithm in ('mem', 'mem2', 'mem-gpu'):
         raise StandardError("The nocc argument is not supported by bwa mem. Try bwa aln instead.")
 
       self.nocc = '-n %s' % (nocc,)
@@ -1178,13 +1610,17 @@ class BwaAlignmentManager(AlignmentManager):
     sai_file1 = "%s.sai" % fqname
     sai_file2 = "%s.sai" % fqname2
 
+    # Each file name is quoted once and reused throughout.
+    (qfqname, qfqname2) = (bash_quote(fqname), bash_quote(fqname2))
+    (qsai_file1, qsai_file2) = (bash_quote(sai_file1), bash_quote(sai_file2))
+
     jobname_bam = "%s_bam" % (jobtag,)
-    outbambase  = bash_quote(fqname)
+    outbambase  = qfqname
     outbam      = outbambase + ".bam"
 
     readgroup = ""
 
-    quoted_fqnames = [bash_quote(fqname), bash_quote(fqname2), bash_quote(fqname), bash_quote(fqname2)]
+    quoted_fqnames = [qfqname, qfqname2, qfqname, qfqname2]
     ncommands = ""
     cmd = ""
     acmd = ""
@@ -1203,10 +1639,10 @@ class BwaAlignmentManager(AlignmentManager):
         p021 = "%s_p021" % fqname2
         p022 = "%s_p022" % fqname2
         cmd += "mknod %s p && mknod %s p && mknod %s p && mknod %s p && sleep 1 && " % (p011, p012, p021, p022)
-        ncommands += "zcat %s > %s\n" % (bash_quote(fqname), p011)
-        ncommands += "zcat %s > %s\n" % (bash_quote(fqname), p012)
-        ncommands += "zcat %s > %s\n" % (bash_quote(fqname2), p021)
-        ncommands += "zcat %s > %s\n" % (bash_quote(fqname2), p022)
+        ncommands += "zcat %s > %s\n" % (qfqname, p011)
+        ncommands += "zcat %s > %s\n" % (qfqname, p012)
+        ncommands += "zcat %s > %s\n" % (qfqname2, p021)
+        ncommands += "zcat %s > %s\n" % (qfqname2, p022)
         acmd = "&& rm %s %s %s %s" % (p011, p012, p021, p022)
         quoted_fqnames = [p011, p021, p012, p022]
       if fqname.endswith('.bz2'):
@@ -1215,20 +1651,20 @@ class BwaAlignmentManager(AlignmentManager):
         p021 = "%s_p021" % fqname2
         p022 = "%s_p022" % fqname2
         cmd += "mknod %s p && mknod %s p && mknod %s p && mknod %s p && sleep 1 && " % (p011, p012, p021, p022)
-        ncommands += "pzcat %s > %s\n" % (bash_quote(fqname), p011)
-        ncommands += "pzcat %s > %s\n" % (bash_quote(fqname), p012)
-        ncommands += "pzcat %s > %s\n" % (bash_quote(fqname2), p021)
-        ncommands += "pzcat %s > %s\n" % (bash_quote(fqname2), p022)
+        ncommands += "pzcat %s > %s\n" % (qfqname, p011)
+        ncommands += "pzcat %s > %s\n" % (qfqname, p012)
+        ncommands += "pzcat %s > %s\n" % (qfqname2, p021)
+        ncommands += "pzcat %s > %s\n" % (qfqname2, p022)
         acmd = "&& rm %s %s %s %s" % (p011, p012, p021, p022)
         quoted_fqnames = [p011, p021, p012, p022]
       
     # Run bwa aln
     cmd1 = "%s aln -t %d %s %s %s > %s" % (self.bwa_prog, self.threads, readgroup, genome,
                                   quoted_fqnames[0],
-                                  bash_quote(sai_file1))
+                                  qsai_file1)
     cmd2 = "%s aln -t %d %s %s %s > %s" % (self.bwa_prog, self.threads, readgroup, genome,
                                   quoted_fqnames[1],
-                                  bash_quote(sai_file2))
+                                  qsai_file2)
 
     # Variables for picard tools
     # Some options are universal. Consider also adding QUIET=true, VERBOSITY=ERROR, TMP_DIR=DBCONF.tmpdir.
@@ -1244,8 +1680,8 @@ class BwaAlignmentManager(AlignmentManager):
     
     # Run bwa sampe
     ncommands += ("%s sampe %s %s %s %s %s %s"
-             % (self.bwa_prog, self.nocc, genome, bash_quote(sai_file1),
-                bash_quote(sai_file2), quoted_fqnames[2], quoted_fqnames[3]))
+             % (self.bwa_prog, self.nocc, genome, qsai_file1,
+                qsai_file2, quoted_fqnames[2], quoted_fqnames[3]))
 
     # Convert to bam
     ncommands += (" | %s view -b -S -u - > %s\n" % (self.samtools_prog, p1))
@@ -1274,15 +1710,14 @@ class BwaAlignmentManager(AlignmentManager):
       LOGGER.error("Failed to create %s:%s" % (self.conf.cluster, nfname))
       sys.exit(1)
 
-    cmd3 += " && npiper -i %s && rm %s %s %s %s %s %s %s %s" % (nfname, bash_quote(fqname), p1, p2, p3, nfname, sai_file1, sai_file2, acmd)
+    cmd3 += " && npiper -i %s && rm %s %s %s %s %s %s %s %s" % (nfname, qfqname, p1, p2, p3, nfname, sai_file1, sai_file2, acmd)
 
-    LOGGER.info("starting bwa step1 on '%s'", fqname)
+    LOGGER.info("starting bwa step1 on '%s' and '%s'", fqname, fqname2)
     
-    jobid_sai1 = self._submit_lsfjob(cmd1, jobname1, sleep=delay, mem=int(self.conf.clustermem), threads=self.threads)
-    LOGGER.debug("got job id '%s'", jobid_sai1)
-    LOGGER.info("starting bwa step1 on '%s'", fqname2)
-    jobid_sai2 = self._submit_lsfjob(cmd2, jobname2, sleep=delay, mem=int(self.conf.clustermem), threads=self.threads)
-    LOGGER.debug("got job id '%s'", jobid_sai2)
+    (jobid_sai1, jobid_sai2) = self._submit_lsfjobs([ (cmd1, jobname1), (cmd2, jobname2) ],
+                                                    sleep=delay, mem=int(self.conf.clustermem),
+                                                    threads=self.threads)
+    LOGGER.debug("got job ids '%s' and '%s'", jobid_sai1, jobid_sai2)
 
     if jobid_sai1 and jobid_sai2:
       LOGGER.info("preparing bwa step2 on '%s'", fqname)
@@ -1299,13 +1734,14 @@ class BwaAlignmentManager(AlignmentManager):
     '''
     Run bwa aln on single-ended sequencing data.
     '''
+    qfqname     = bash_quote(fqname)
     jobname_bam = "%s_bam" % (jobtag,)
-    outbambase  = bash_quote(fqname)
+    outbambase  = qfqname
     outbam      = outbambase + ".bam"
     
     readgroup = ""
 
-    quoted_fqname = [bash_quote(fqname), bash_quote(fqname)]
+    quoted_fqname = [qfqname, qfqname]
     ncommands = ""
     cmd = ""
     acmd = ""
@@ -1321,16 +1757,16 @@ class BwaAlignmentManager(AlignmentManager):
         p01 = "%s_p01" % fqname
         p02 = "%s_p02" % fqname
         cmd = "mknod %s p && mknod %s p && sleep 1 && " % (p01, p02)
-        ncommands += "zcat %s > %s\n" % (bash_quote(fqname), p01)
-        ncommands += "zcat %s > %s\n" % (bash_quote(fqname), p02)
+        ncommands += "zcat %s > %s\n" % (qfqname, p01)
+        ncommands += "zcat %s > %s\n" % (qfqname, p02)
         acmd = "&& rm %s %s" % (p01, p02)
         quoted_fqname = [p01, p02]
       if fqname.endswith('.bz2'):
         p01 = "%s_p01" % fqname
         p02 = "%s_p02" % fqname
         cmd = "mknod %s p && mknod %s p && sleep 1 && " % (p01, p02)
-        ncommands += "bzcat %s > %s\n" % (bash_quote(fqname), p01)
-        ncommands += "bzcat %s > %s\n" % (bash_quote(fqname), p02)
+        ncommands += "bzcat %s > %s\n" % (qfqname, p01)
+        ncommands += "bzcat %s > %s\n" % (qfqname, p02)
         acmd = "&& rm %s %s" % (p01, p02)
         quoted_fqname = [p01, p02]
 
@@ -1380,7 +1816,7 @@ class BwaAlignmentManager(AlignmentManager):
       LOGGER.error("Failed to create %s:%s" % (self.conf.cluster, nfname))
       sys.exit(1)
 
-    cmd += " && npiper -i %s && rm %s %s %s %s %s %s" % (nfname, bash_quote(fqname), p1, p2, p3, nfname, acmd)
+    cmd += " && npiper -i %s && rm %s %s %s %s %s %s" % (nfname, qfqname, p1, p2, p3, nfname, acmd)
     
     LOGGER.info("starting bwa on '%s'", fqname)
     LOGGER.debug(cmd)
@@ -1402,24 +1838,51 @@ class BwaAlignmentManager(AlignmentManager):
 
     return "\'@RG\tID:%d\tPL:%s\tPU:%d\tLB:%s\tSM:%s\tCN:%s\'" % (int(lanenum),'illumina',int(lanenum), libcode, sample, facility)
   
-  def _run_bwa_mem(self, fqnames, genome, jobtag, output_fn, samplename, delay=0, compress_output=False):
+  def _cache_index(self, genome):
+    '''
+    If the indexcachedir config option is set (typically somewhere
+    under /dev/shm), return a command prefix which copies the genome
+    index files into that directory on the compute node, along with
+    the cached genome path to pass to bwa. The copying, and removal of
+    cached genomes no longer in use, is left to cs_cacheBwaIndex.py;
+    later jobs on the node reuse the copy. Otherwise returns ('',
+    genome).
     '''
-    Run bwa mem on single- or paired-end sequencing data.
+    try:
+      cacheroot = self.conf.indexcachedir
+    except AttributeError, _err:
+      return ('', genome)
+
+    (gpath, gname) = os.path.split(genome)
+    cachedir = os.path.join(cacheroot, gpath.strip('/').replace('/', '_'))
+    exts = BWA_INDEX_EXTENSIONS[self.bwa_algorithm]
+    prefix = ("%s --loglevel %d %s %s %s && "
+              % (CACHE_INDEX_PROG, LOGGER.getEffectiveLevel(),
+                 bash_quote(genome), bash_quote(cachedir), " ".join(exts)))
+
+    return (prefix, os.path.join(cachedir, gname))
+
+  def _bwa_mem_command(self, fqnames, genome, output_fn, samplename, compress_output=False):
+    '''
+    Build the cluster command running bwa mem on single- or
+    paired-end sequencing data. Returns the command and the name of
+    the bam file it creates.
     '''
     
     assert(len(fqnames) in (1, 2))
 
-    jobname_bam = "%s_bam" % (jobtag,)
     outbambase  = bash_quote(fqnames[0])
     outbam      = outbambase + ".bam"
     
     readgroup = ""
 
     ncommands = ""
-    cmd = ""
     acmd = ""
     quoted_fqnames = " ".join([ bash_quote(fqn) for fqn in fqnames ])
 
+    # Align against a node-local copy of the index where configured.
+    (cmd, genome) = self._cache_index(genome)
+
     # Check if readgroup information should be added by bwa
     if self.split is False:
       readgroup = "-R %s" % self._make_readgroup_string(output_fn, samplename)
@@ -1464,8 +1927,10 @@ class BwaAlignmentManager(AlignmentManager):
 
     cmd += "mknod %s p && mknod %s p && mknod %s p && sleep 1" % (p1, p2, p3)
 
-    # Run bwa mem
-    ncommands += "%s mem %s -t %d %s %s" % (self.bwa_prog, readgroup, self.threads, genome, quoted_fqnames)
+    # Run bwa mem. For bwa-mem2 we fix the batch size (-K) so that
+    # output does not depend on the number of threads.
+    batchsize = "-K 100000000 " if self.bwa_algorithm == 'mem2' else ""
+    ncommands += "%s mem %s%s -t %d %s %s" % (self.bwa_prog, batchsize, readgroup, self.threads, genome, quoted_fqnames)
 
     # Run sam to bam conversion
     ncommands += (" | %s view -b -S -u - > %s\n" % (self.samtools_prog, p1))
@@ -1501,12 +1966,49 @@ class BwaAlignmentManager(AlignmentManager):
 #    cmd += " && npiper -i %s && rm %s %s %s %s %s %s" % (nfname, p1, p2, p3, nfname, quoted_fqnames, acmd)
     cmd += " && npiper -i %s && rm %s %s %s %s %s %s" % (nfname, p1, p2, p3, nfname, quoted_fqnames, acmd)
     
-    LOGGER.info("Starting bwa mem on fastq files: %s", quoted_fqnames)
+    LOGGER.info("Starting %s mem on fastq files: %s", self.bwa_prog, quoted_fqnames)
     LOGGER.debug(cmd)
-    jobid_bam = self._submit_lsfjob(cmd, jobname_bam, sleep=delay, mem=int(self.conf.clustermem), threads=self.threads)
+
+    return(cmd, outbam)
+
+  def _run_fq2bam(self, fqnames, genome, jobtag, output_fn, samplename, delay=0):
+    '''
+    Run Parabricks fq2bam on unsplit single- or paired-end sequencing
+    data, submitting to the GPU queue (config option clustergpuqueue,
+    default 'gpu'). The output bam is sorted and compressed.
+    '''
+    assert(len(fqnames) in (1, 2))
+
+    jobname_bam = "%s_bam" % (jobtag,)
+
+    try:
+      queue = self.conf.clustergpuqueue
+    except AttributeError, _err:
+      queue = 'gpu'
+    try:
+      gpus = int(self.conf.num_gpus)
+    except AttributeError, _err:
+      gpus = 1
+
+    # pbrun expects the read group tab separators escaped, and takes
+    # the read group as the final --in-fq/--in-se-fq argument.
+    readgroup = self._make_readgroup_string(output_fn, samplename).replace('\t', r'\t')
+    quoted_fqnames = " ".join([ bash_quote(fqn) for fqn in fqnames ])
+    infq = '--in-fq' if len(fqnames) == 2 else '--in-se-fq'
+
+    cmd = ("%s fq2bam --num-gpus %d --ref %s %s %s %s --out-bam %s --tmp-dir %s"
+           % (self.bwa_prog, gpus, genome, infq, quoted_fqnames, readgroup,
+              bash_quote(output_fn), self.conf.clusterworkdir))
+    if self.cleanup:
+      cmd += " && rm %s" % (quoted_fqnames,)
+
+    LOGGER.info("Starting %s fq2bam on fastq files: %s", self.bwa_prog, quoted_fqnames)
+    LOGGER.debug(cmd)
+    jobid_bam = self._submit_lsfjob(cmd, jobname_bam, sleep=delay, mem=int(self.conf.clustermem),
+                                    threads=self.threads, queue=queue, gpus=gpus)
     LOGGER.debug("got job id '%s'", jobid_bam)
 
-    return(jobid_bam, outbam)
+    return(jobid_bam, output_fn)
 
   def run_bwas(self, genome, paired, fq_files, fq_files2, output_fn, samplename):
     '''
@@ -1514,6 +2016,7 @@ class BwaAlignmentManager(AlignmentManager):
     '''
     job_ids = []
     out_names = []
+    mem_commands = []
     current = 0
     # splits the fq_file by underscore and returns first element which
     # in current name
@@ -1541,31 +2044,59 @@ class BwaAlignmentManager(AlignmentManager):
           (jobid, outbam) = self._run_singleend_bwa_aln(fqname,
                                                         genome, jobtag, output_fn, samplename, current, compress_output=compress_output)
 
-      # Newer bwa mem algorithm.
-      elif self.bwa_algorithm == 'mem':
+      # Newer bwa mem algorithm (or its bwa-mem2 reimplementation). The
+      # commands are collected and all submitted together below.
+      elif self.bwa_algorithm in ('mem', 'mem2'):
 
         fqnames = [ fqname ]
         if paired:
           fqnames.append(fq_files2[current])
           
-        (jobid, outbam) = self._run_bwa_mem(fqnames, genome, jobtag, output_fn, samplename, compress_output=compress_output)
-        
+        (cmd, outbam) = self._bwa_mem_command(fqnames, genome, output_fn, samplename, compress_output=compress_output)
+        mem_commands.append(cmd)
+        jobid = None
+
+      # GPU implementation; never split.
+      elif self.bwa_algorithm == 'mem-gpu':
+
+        fqnames = [ fqname ]
+        if paired:
+          fqnames.append(fq_files2[current])
+
+        (jobid, outbam) = self._run_fq2bam(fqnames, genome, jobtag, output_fn, samplename)
+
       else:
         raise ValueError("BWA algorithm not recognised: %s" % self.bwa_algorithm)
 
-      job_ids.append(jobid)
+      if jobid is not None:
+        job_ids.append(jobid)
       out_names.append(outbam)
       current += 1
 
+    # All bwa mem splits go up in one submission (a job array on LSF).
+    if mem_commands:
+      job_ids = self._submit_lsfarray(mem_commands, "%s_bam" % fq_files[0].split("_")[0],
+                                      mem=int(self.conf.clustermem), threads=self.threads)
+      LOGGER.debug("got job ids '%s'", job_ids)
+
     return (job_ids, out_names)
 
-  def _get_foreign_file(self, fn, host, attempts = 1, sleeptime = 2):
+  def _get_foreign_file(self, fn, host, attempts = 3, sleeptime = 2):
     '''Download file located in host'''
 
     # NOTE: We may still need to double-quote spaces the destination
     # passed to scp. Double-quoting brackets ([]) does not work, though.
 
     (path, fname) = os.path.split(fn)
+
+    # A .done marker is written on successful download; if present
+    # alongside the file (e.g. on re-running after a crash), skip the
+    # transfer altogether.
+    marker = fname + '.done'
+    if os.path.exists(fname) and os.path.exists(marker):
+      LOGGER.info("%s already downloaded; skipping transfer.", fname)
+      return
+
     # If cluster data transfer host has been set transfer via transfer host, otherwise transfer directly
     transferhost = None
     try:
@@ -1573,17 +2104,25 @@ class BwaAlignmentManager(AlignmentManager):
     except AttributeError, _err:
       transferhost = None
     if transferhost is not None:
+      shell = True
       cmd = "ssh %s@%s \"rsync -a -e \\\"ssh -o StrictHostKeyChecking=no -c aes128-cbc\\\" %s@%s:%s %s\"" % (self.conf.clusteruser, transferhost, self.conf.clusteruser, host, bash_quote(fn), os.path.join(self.conf.clusterworkdir, bash_quote(fname)) )
     else:
-      cmd = "rsync -a -e \"ssh -o StrictHostKeyChecking=no -c aes128-cbc\" %s@%s:%s %s" % (self.conf.clusteruser, host, bash_quote(fn), bash_quote(fname) )
+      # The remote path is still interpreted by the remote shell, so
+      # remains quoted; the local one goes straight to rsync.
+      shell = False
+      cmd = ['rsync', '-a', '-e', RSYNC_SSH,
+             "%s@%s:%s" % (self.conf.clusteruser, host, bash_quote(fn)), fname]
 
     LOGGER.info("Downloading %s" % (fname))
     
     start_time = time.time()
+    tries = 0
     while attempts > 0:
-      subproc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-      (stdout, stderr) = subproc.communicate()
-      retcode = subproc.wait()
+      tries += 1
+      with transfer_slot():
+        subproc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=shell)
+        (stdout, stderr) = subproc.communicate()
+        retcode = subproc.wait()
       if stdout is not None:
         sys.stdout.write(stdout)
       if stderr is not None:
@@ -1595,16 +2134,27 @@ class BwaAlignmentManager(AlignmentManager):
         LOGGER.warning(\
                        'Transfer failed with error code: %s\nTrying again (max %d times)',
                        stderr, attempts)
-        time.sleep(sleeptime)
+        time.sleep(backoff_delay(sleeptime, tries))
       else:
         break
         
     if retcode !=0:
+      if not shell:
+        cmd = " ".join(cmd)
       raise StandardError("ERROR. Failed to transfer file. Command was:\n   %s\n"
-                  % (" ".join(cmd),) )    
+                  % (cmd,) )    
+    open(marker, 'a').close()
     time_diff = time.time() - start_time
     LOGGER.info("%s transferred in %d seconds." % (fname, time_diff) )
-    
+
+  def _get_foreign_files(self, fns, host):
+    '''
+    Download several files located in host concurrently, one thread
+    per file (typically one or two fastq files). Any error raised by a
+    transfer is re-raised once all threads have finished.
+    '''
+    run_in_threads(lambda fn: self._get_foreign_file(fn, host), fns)
+
   def split_and_align(self, files, genome, samplename, rcp_target=None, lcp_target=None, fileshost=None):
     '''
     Method used to launch the initial file splitting and bwa
@@ -1616,26 +2166,32 @@ class BwaAlignmentManager(AlignmentManager):
     # fileshost - host where the target fastq files are located. If none, the files are expected to be local and accessible cluster wide.
     #
 
-    # Transfer files in.
-    local_files = []
-    for fn in files:
-      if fileshost is not None:
-        # Throw an error in case files host is specified but no path to the files.
-        self._get_foreign_file(fn, fileshost)
-      (path, fname) = os.path.split(fn)
-      local_files.append(fname)
+    # Files to be split are streamed directly from fileshost into
+    # split, so that no time is spent staging them locally first. This
+    # is not possible if transfers must go via a separate transfer host.
+    try:
+      transferhost = self.conf.transferhost
+    except AttributeError, _err:
+      transferhost = None
+    stream = fileshost is not None and self.split and transferhost is None
 
-    # Split file(s)
-    if self.split:      
+    # Otherwise, transfer files in.
+    if fileshost is not None and not stream:
+      self._get_foreign_files(files, fileshost)
+    local_files = [ os.path.split(fn)[1] for fn in files ]
+
+    # Split file(s); paired-end files are split concurrently.
+    if stream:
+      assert( self.merge_prog is not None )
+      split_files = self.split_fqs(files[:2], fileshost)
+    elif self.split:
       assert( self.merge_prog is not None )
-      fq_files = self.split_fq(local_files[0])
+      split_files = self.split_fqs(local_files[:2])
     else:
-      fq_files = [local_files[0]]
+      split_files = [ [fn] for fn in local_files[:2] ]
+    fq_files = split_files[0]
     if len(local_files) == 2:
-      if self.split:
-        fq_files2 = self.split_fq(local_files[1])
-      else:
-        fq_files2 = [local_files[1]]
+      fq_files2 = split_files[1]
       paired = True
     elif len(local_files) == 1:
         fq_files2 = None
@@ -1700,7 +2256,7 @@ class TophatAlignmentManager(AlignmentManager):
     '''
     Submits tophat2 alignment jobs for list of fq files to LSF cluster.
     '''
-    job_ids = []
+    commands = []
     out_names = []
     current = 0
 
@@ -1710,8 +2266,8 @@ class TophatAlignmentManager(AlignmentManager):
     for fqname in fq_files:
       (donumber, facility, lanenum, _pipe) = parse_repository_filename(fqname)
 
-      # Used as a job ID and also as an output directory, so we want
-      # it fairly collision-resistant.
+      # Used as an output directory, so we want it fairly
+      # collision-resistant.
       jobname_bam = "%s_tophat" % fqname
 
       out = bash_quote(fqname + ".bam")
@@ -1720,20 +2276,21 @@ class TophatAlignmentManager(AlignmentManager):
       # Run tophat2. The no-coverage-search option is required when
       # splitting the fastq file across multiple cluster nodes. The
       # fr-firststrand library type is the Odom lab default. We
-      # use the -p option to ask for more threads; FIXME config option?
-      cmd  = ("%s --no-coverage-search --library-type fr-firststrand -p 4 -o %s %s %s"
-               % (self.tophat_prog, jobname_bam, genome, bash_quote(fqname)))
+      # use the -p option to ask for as many threads as the job has
+      # cores (see the num_threads config option).
+      cmd  = ("%s --no-coverage-search --library-type fr-firststrand -p %d -o %s %s %s"
+               % (self.tophat_prog, self.threads, jobname_bam, genome, bash_quote(fqname)))
       if paired:
         cmd += " %s" % (bash_quote(fq_files2[current]),)
 
       # Merge the mapped and unmapped outputs, clean out unwanted
       # secondary alignments. Tophat2 sorts the output bams by default.
       strippedbam = "%s.partial" % out
-      cmd += (" && %s view -b -F 0x100 -o %s %s"
-               % (self.samtools_prog, strippedbam,
+      cmd += (" && %s view -@ %d -b -F 0x100 -o %s %s"
+               % (self.samtools_prog, self.threads, strippedbam,
                    os.path.join(jobname_bam, 'accepted_hits.bam')))
-      cmd += (" && %s merge %s %s %s"
-               % (self.samtools_prog, out, strippedbam,
+      cmd += (" && %s merge -@ %d %s %s %s"
+               % (self.samtools_prog, self.threads, out, strippedbam,
                   os.path.join(jobname_bam, 'unmapped.bam')))
 
       # Clean up
@@ -1743,12 +2300,15 @@ class TophatAlignmentManager(AlignmentManager):
         
       LOGGER.info("starting tophat2 on '%s'", fqname)
       LOGGER.debug(cmd)
-      jobid_bam = self._submit_lsfjob(cmd, jobname_bam, sleep=current)
-      LOGGER.debug("got job id '%s'", jobid_bam)
-      job_ids.append(jobid_bam)
+      commands.append(cmd)
 
       current += 1
 
+    # All splits are submitted together (as a job array on LSF).
+    job_ids = self._submit_lsfarray(commands, "%s_tophat" % fq_files[0],
+                                    threads=self.threads)
+    LOGGER.debug("got job ids '%s'", job_ids)
+
     return (job_ids, out_names)
     
   def split_and_align(self, files, genome, samplename, rcp_target=None):
@@ -1759,10 +2319,11 @@ class TophatAlignmentManager(AlignmentManager):
     the final bam file.
     '''
     assert( self.merge_prog is not None )
-    fq_files = self.split_fq(files[0])
+    split_files = self.split_fqs(files[:2])
+    fq_files = split_files[0]
     paired = False
     if len(files) == 2:
-      fq_files2 = self.split_fq(files[1])
+      fq_files2 = split_files[1]
       paired = True
     elif len(files) == 1:
       fq_files2 = None
@@ -1797,17 +2358,13 @@ class StarAlignmentManager(AlignmentManager):
     '''
     Submits STAR alignment jobs for list of fq files to cluster.
     '''
-    job_ids = []
+    commands = []
     out_names = []
     current = 0
 
     for fqname in fq_files:
       (donumber, facility, lanenum, _pipe) = parse_repository_filename(fqname)
 
-      # Used as a job ID and also as an output directory, so we want
-      # it fairly collision-resistant.
-      jobname_bam = "%s_STAR" % fqname
-
       out = bash_quote(fqname + ".bam")
       out_names.append(out)
 
@@ -1835,12 +2392,15 @@ class StarAlignmentManager(AlignmentManager):
         
       LOGGER.info("starting STAR on '%s'", fqname)
       LOGGER.debug(cmd)
-      jobid_bam = self._submit_lsfjob(cmd, jobname_bam, sleep=current, mem=int(self.conf.clustermem), threads=self.threads)
-      LOGGER.debug("got job id '%s'", jobid_bam)
-      job_ids.append(jobid_bam)
+      commands.append(cmd)
 
       current += 1
 
+    # All splits are submitted together (as a job array on LSF).
+    job_ids = self._submit_lsfarray(commands, "%s_STAR" % fq_files[0],
+                                    mem=int(self.conf.clustermem), threads=self.threads)
+    LOGGER.debug("got job ids '%s'", job_ids)
+
     return (job_ids, out_names)
 
   def split_and_align(self, files, genome, samplename, rcp_target=None, lcp_target=None, fileshost=None):
@@ -1863,17 +2423,15 @@ class StarAlignmentManager(AlignmentManager):
       (path, fname) = os.path.split(fn)
       local_files.append(fname)
 
-    # Split file(s)
+    # Split file(s); paired-end files are split concurrently.
     if self.split:      
       assert( self.merge_prog is not None )
-      fq_files = self.split_fq(local_files[0])
+      split_files = self.split_fqs(local_files[:2])
     else:
-      fq_files = [local_files[0]]
+      split_files = [ [fn] for fn in local_files[:2] ]
+    fq_files = split_files[0]
     if len(local_files) == 2:
-      if self.split:
-        fq_files2 = self.split_fq(local_files[1])
-      else:
-        fq_files2 = [local_files[1]]
+      fq_files2 = split_files[1]
       paired = True
     elif len(local_files) == 1:
         fq_files2 = None
@@ -54,10 +54,10 @@ def count_bam_reads(bam):
 def identify_bwa_algorithm(bam):
   '''
   Function which looks at the bam file header to try and identify
-  whether bwa aln or bwa mem was used. Requires a recent version of
-  bwa. Therefore if the appropriate annotation is not found, it is
-  assumed that bwa aln was used. Function will likely raise an error if a
-  non-bwa bam file is tested.
+  whether bwa aln or bwa mem was used (bwa-mem2 output is reported as
+  mem). Requires a recent version of bwa. Therefore if the appropriate
+  annotation is not found, it is assumed that bwa aln was used.
+  Function will likely raise an error if a non-bwa bam file is tested.
   '''
   LOGGER.info("Checking BWA algorithm bam file %s", bam)
   cmd  = (CONFIG.read_sorter, 'view', '-H', bam)
@@ -72,7 +72,7 @@ def identify_bwa_algorithm(bam):
                      if not re.match('^@', field) )
       if 'CL' in fields:
         (prog, algo, rest) = fields['CL'].split(" ", 2)
-        if prog != 'bwa':
+        if prog not in ('bwa', 'bwa-mem2'):
           raise ValueError("Expected bwa aligner, found %s" % prog)
         if algo == 'samse': # aln is implied
           algo = 'aln'
@@ -28,6 +28,7 @@
 import os
 import time
 import os.path
+import argparse
 import sys
 import re
 from tempfile import TemporaryFile
@@ -41,6 +42,8 @@ from subprocess import Popen, CalledProcessError, PIPE
 from distutils import spawn
 import threading
 import socket
+import fcntl
+import random
 from .config import Config
 from .setup_logs import configure_logging
 from functools import wraps
@@ -53,6 +56,34 @@ from functools import wraps
 DBCONF = Config()
 LOGGER = configure_logging('utilities')
 
+# Regular expressions used in frequently-called functions below are
+# compiled once here rather than on every call.
+
+# N.B. don't add a bounding '$' as this doesn't match the whole
+# filename for e.g. *.mga.pdf. The terminal \. is important, in that
+# the MGA files will match but fastq will not. This match is dumped
+# as pipeline, which is semantically wrong but used consistently
+# elsewhere. FIXME to correctly return file type!
+REPOSITORY_FNAME_RE = re.compile(
+  r"([a-zA-Z]+\d+)_.*_([A-Z]+)(\d+)(p[12])?(_chr21)?(\.[a-z]+)?\.")
+
+# Takes first part of the filename up to the first underscore or period.
+LIBCODE_RE = re.compile(r"^([^\._]+)")
+
+# The following are all legal characters in a file path.
+BASH_QUOTE_RE = re.compile('(?=[^-+0-9a-zA-Z_,./\n])')
+
+SAMPLENAME_RE = re.compile(r'([ \\\/\(\)\"\*:;&|<>]+)')
+
+# ssh/scp options multiplexing connections, so that successive
+# commands to the same host reuse a single ssh session rather than
+# each paying for a new handshake. Requires OpenSSH 5.6 or later.
+SSH_MUX_OPTS = ('-o ControlMaster=auto -o ControlPath=/tmp/ssh-%r@%h:%p'
+                + ' -o ControlPersist=60s')
+
+# Remote shell used by rsync transfers.
+RSYNC_SSH = 'ssh -o StrictHostKeyChecking=no -c aes128-cbc ' + SSH_MUX_OPTS
+
 ###########################################################################
 # Now for the rest of the utility functions...
 
@@ -207,16 +238,19 @@ def flexi_open(filename, *args, **kwargs):
 
   handle.close()
 
-def _checksum_fileobj(fileobj, blocksize=65536):
+def _checksum_fileobj(fileobj, blocksize=1048576):
   '''
   Use the hashlib.md5() function to calculate MD5 checksum on a file
-  object, in a reasonably memory-efficient way.
+  object, in a reasonably memory-efficient way. A single buffer is
+  reused via readinto() so that no new string is allocated per block.
   '''
   hasher = hashlib.md5()
-  buf = fileobj.read(blocksize)
-  while len(buf) > 0:
-    hasher.update(buf)
-    buf = fileobj.read(blocksize)
+  buf    = bytearray(blocksize)
+  view   = memoryview(buf)
+  nbytes = fileobj.readinto(buf)
+  while nbytes:
+    hasher.update(view[:nbytes])
+    nbytes = fileobj.readinto(buf)
 
   return hasher.hexdigest()
 
@@ -244,14 +278,7 @@ def parse_repository_filename(fname):
   fnparts = os.path.splitext(fname)
   if fnparts[1] == DBCONF.gzsuffix:
     fname = fnparts[0]
-  # N.B. don't add a bounding '$' as this doesn't match the whole
-  # filename for e.g. *.mga.pdf. The terminal \. is important, in that
-  # the MGA files will match but fastq will not. This match is dumped
-  # as pipeline, which is semantically wrong but used consistently
-  # elsewhere. FIXME to correctly return file type!
-  name_pattern = re.compile(
-    r"([a-zA-Z]+\d+)_.*_([A-Z]+)(\d+)(p[12])?(_chr21)?(\.[a-z]+)?\.")
-  matchobj = name_pattern.match(fname)
+  matchobj = REPOSITORY_FNAME_RE.match(fname)
   if matchobj:
     label = matchobj.group(1)
     fac = matchobj.group(2)
@@ -268,9 +295,7 @@ def parse_repository_filename(fname):
 def get_filename_libcode(fname):
   '''Extract the library code from a given filename.'''
 
-  # Takes first part of the filename up to the first underscore or period.
-  name_pattern = re.compile(r"^([^\._]+)")
-  matchobj = name_pattern.match(fname)
+  matchobj = LIBCODE_RE.match(fname)
   return matchobj.group(1)
 
 def set_file_permissions(group, path):
@@ -290,9 +315,7 @@ def bash_quote(string):
   '''Quote a string (e.g. a filename) to allow its use with bash and
   bash-related commands such as bsub, scp etc.'''
 
-  # The following are all legal characters in a file path.
-  bash_re = re.compile('(?=[^-+0-9a-zA-Z_,./\n])')
-  return bash_re.sub('\\\\', string)
+  return BASH_QUOTE_RE.sub('\\\\', string)
 
 # Currently unused, we're keeping this in case it's useful in future.
 def split_to_codes(string):
@@ -387,12 +410,15 @@ def call_subprocess(cmd, shell=False, tmpdir=DBCONF.tmpdir, path=None,
   # Credit to the maintainer of python-gnupg, Vinay Sajip, for the
   # original design of this function.
 
-  # Set our PATH environmental var to point to the desired location.
-  oldpath = os.environ['PATH']
+  # Set the child's PATH environmental var to point to the desired
+  # location. This is passed via env rather than by modifying
+  # os.environ, so that concurrent calls from other threads are safe.
   if path is not None:
     if type(path) is list:
       path = ":".join(path)
-    os.environ['PATH'] = path
+    env = dict(kwargs.pop('env', None) or os.environ)
+    env['PATH'] = path
+    kwargs['env'] = env
   else:
     LOGGER.warn("Subprocess calling external executable using undefined $PATH.")
 
@@ -432,8 +458,6 @@ def call_subprocess(cmd, shell=False, tmpdir=DBCONF.tmpdir, path=None,
 
   stdoutfd.seek(0, 0)
 
-  os.environ['PATH'] = oldpath
-
   if retcode != 0:
 
     stderrfd.seek(0, 0)
@@ -516,8 +540,7 @@ def sanitize_samplename(samplename):
   '''
   if samplename is None:
     return None
-  sanity_re = re.compile(r'([ \\\/\(\)\"\*:;&|<>]+)')
-  return(sanity_re.sub('_', samplename))
+  return(SAMPLENAME_RE.sub('_', samplename))
 
 def determine_readlength(fastq):
   '''
@@ -535,6 +558,41 @@ def determine_readlength(fastq):
 
   return rlen
 
+def parse_base_count(string):
+  '''
+  Convert a sequence length such as "500M" or "2Gb" (or a plain
+  integer) into a number of bases. Raises argparse.ArgumentTypeError
+  unless the result is a positive number.
+  '''
+  multipliers = {'k': 10**3, 'm': 10**6, 'g': 10**9}
+  orig   = string
+  string = string.strip().lower()
+  if string.endswith('b'):
+    string = string[:-1]
+  factor = 1
+  if string and string[-1] in multipliers:
+    factor = multipliers[string[-1]]
+    string = string[:-1]
+  try:
+    bases = int(float(string) * factor)
+  except ValueError:
+    raise argparse.ArgumentTypeError("invalid base count: %r" % orig)
+  if bases <= 0:
+    raise argparse.ArgumentTypeError("base count must be positive: %r" % orig)
+  return bases
+
+def reads_for_bases(fastq, bases):
+  '''
+  Estimate the number of reads in fastq amounting to the given number
+  of bases, using the first read length as representative. Raises
+  ValueError if bases is less than one read.
+  '''
+  readlength = determine_readlength(fastq)
+  if bases < readlength:
+    raise ValueError("Split size of %d bases is less than one read (%d bases) in %s."
+                     % (bases, readlength, fastq))
+  return bases // readlength
+
 def memoize(func):
   '''
   Convenience function to memoize functions as necessary. May be of
@@ -555,6 +613,26 @@ def memoize(func):
     return cache[args]
   return wrap
 
+@memoize
+def which(program, path=None):
+  '''
+  Memoized wrapper around distutils.spawn.find_executable, so that
+  repeated lookups do not rescan the PATH (often on a networked
+  filesystem). Arguments must be passed positionally.
+  '''
+  return spawn.find_executable(program, path)
+
+def find_merge_prog():
+  '''
+  Locate the cs_runBwaWithSplit_Merge.py script used by the split
+  alignment wrappers. The optional mergeprog config option, if set,
+  avoids searching the PATH altogether.
+  '''
+  try:
+    return DBCONF.mergeprog
+  except AttributeError, _err:
+    return which('cs_runBwaWithSplit_Merge.py', os.environ['PATH'])
+
 def write_to_remote_file(txt, remotefname, user, host, append=False, sshkey=None):
 
   a = ''
@@ -565,7 +643,7 @@ def write_to_remote_file(txt, remotefname, user, host, append=False, sshkey=None
     sshcmd = 'ssh'
   else:
     sshcmd = 'ssh -i %s' % sshkey
-  cmd = "%s -o StrictHostKeyChecking=no %s@%s 'cat - %s> %s'" % (sshcmd, user, host, a, remotefname)
+  cmd = "%s -o StrictHostKeyChecking=no %s %s@%s 'cat - %s> %s'" % (sshcmd, SSH_MUX_OPTS, user, host, a, remotefname)
   p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True)
   p.stdin.write(txt)
   
@@ -622,6 +700,62 @@ def run_in_communication_host(argv):
   
   sys.exit(retcode)
 
+def backoff_delay(sleeptime, attempt, maxdelay=60):
+  '''
+  Return the number of seconds to wait before retry number attempt
+  (counting from 1), doubling each time up to maxdelay and adding
+  random jitter so that concurrent jobs do not all retry at once.
+  '''
+  return min(maxdelay, sleeptime * (2 ** (attempt - 1))) \
+      + random.uniform(0, sleeptime)
+
+@contextmanager
+def transfer_slot(nslots=None, lockdir=None, poll=2):
+  '''
+  Context manager limiting the number of concurrent file transfers
+  run from this host, using fcntl locks on a small set of slot files
+  shared by all of the user's processes. The lock files live in a
+  per-user directory (~/.osqutil by default). The number of slots is
+  taken from the optional maxtransfers config option (default 4). If
+  the lock files cannot be used, the transfer runs without a slot.
+  '''
+  if nslots is None:
+    try:
+      nslots = int(DBCONF.maxtransfers)
+    except AttributeError, _err:
+      nslots = 4
+  if lockdir is None:
+    lockdir = os.path.join(os.path.expanduser('~'), '.osqutil')
+
+  handle = None
+  try:
+    if not os.path.isdir(lockdir):
+      os.makedirs(lockdir, 0700)
+    while handle is None:
+      for slot in range(nslots):
+        lockfile = os.path.join(lockdir, 'osqutil_transfer.%d.lock' % slot)
+        fhandle  = open(lockfile, 'a')
+        try:
+          fcntl.flock(fhandle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, _err:
+          fhandle.close()
+          continue
+        handle = fhandle
+        break
+      else:
+        LOGGER.debug("All %d transfer slots busy; waiting.", nslots)
+        time.sleep(poll)
+  except (IOError, OSError), err:
+    LOGGER.warning("Unable to use transfer lock files in %s (%s);"
+                   + " transferring without a slot.", lockdir, err)
+
+  try:
+    yield
+  finally:
+    if handle is not None:
+      fcntl.flock(handle, fcntl.LOCK_UN)
+      handle.close()
+
 def transfer_file(source, destination, attempts = 2, sleeptime = 2, set_ownership=False):
   '''Transfers file from source to destination using rsync. Either source or destination can be a foreign host,
   in which case the string is expected to contain username@host:path.'''
@@ -632,7 +766,7 @@ def transfer_file(source, destination, attempts = 2, sleeptime = 2, set_ownershi
   
   sshflag = ''
   if ':' in source or ':' in destination:
-    sshflag = '-e \"ssh -o StrictHostKeyChecking=no -c aes128-cbc\"'
+    sshflag = '-e \"%s\"' % RSYNC_SSH
 
   # cmd used to have -R option as well, not sure why it was included. Removed by lukk01 24/07  
   # Following has been commented out as rsync in slurm cluster is behind in versions and does not have --chown option.
@@ -644,9 +778,10 @@ def transfer_file(source, destination, attempts = 2, sleeptime = 2, set_ownershi
 
   a = attempts
   while a > 0:
-    subproc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-    (stdout, stderr) = subproc.communicate()
-    retcode = subproc.wait()
+    with transfer_slot():
+      subproc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
+      (stdout, stderr) = subproc.communicate()
+      retcode = subproc.wait()
     # We write stdout and stderr where they belong in case these need to be parsed upstream
     if stdout is not None:
       sys.stdout.write(stdout)
@@ -658,7 +793,7 @@ def transfer_file(source, destination, attempts = 2, sleeptime = 2, set_ownershi
       a -= 1           
       if a <= 0:
         break
-      time.sleep(sleeptime)
+      time.sleep(backoff_delay(sleeptime, attempts - a))
   if retcode != 0:
     LOGGER.error("Failed to transfer %s to %s in %d attempts. Exiting!\n", source, destination, attempts)
     sys.exit(1)
@@ -832,7 +967,7 @@ class BamPostProcessor(object):
     # In case post processing intermediate files are expected to be uncompressed add COMPRESSION_LEVEL=0
     self.compress = compress
     if not compress:
-      self.common_args = self.common_args + ('COMPRESSION_LEVEL=0')
+      self.common_args = self.common_args + ['COMPRESSION_LEVEL=0']
 
   def clean_sam(self):
 